@@ -0,0 +1,39 @@
+"""Gunicorn settings for production, see docker-entrypoint.sh
+
+Every setting can be overridden from the environment, e.g. WEB_CONCURRENCY
+for the number of worker processes.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# Requests spend most of their time waiting on the database, the disk or a
+# remote URL (uploads, captcha), so each worker also runs a few threads
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Page cache invalidations and the image of the day selection must reach
+# every worker, a per-process cache would serve stale pages
+if workers > 1 and os.environ.get('CACHE_URL', '').startswith('locmem://'):
+    raise RuntimeError('CACHE_URL=locmem:// is per process, use file:// or redis:// with several workers')
+
+# Import Django, Pillow, imagehash and NumPy once in the master and share
+# the pages with the forked workers. Nothing may open a database connection
+# at import time for this to be safe.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'True').lower() in ('true', 't', '1', 'yes')
+
+# URL uploads download and hash images of up to MAX_DOWNLOAD_BYTES
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so that memory fragmented by decoding large
+# images is given back to the system
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
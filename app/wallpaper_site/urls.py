@@ -15,10 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+import re
+
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
+from wallpapers.views import media_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -27,5 +29,10 @@ urlpatterns = [
     path('accounts/logout/', auth_views.LogoutView.as_view(next_page='/'), name='logout'),
 ]
 
-# Serve media and static files during development
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Uploaded images, also without DEBUG (static() only serves them with it),
+# unless the front web server serves them itself. Static files are served
+# by WhiteNoise.
+if settings.SERVE_MEDIA:
+    urlpatterns += [
+        re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.+)$', media_file, name='media'),
+    ]
@@ -1,28 +1,34 @@
 from django.contrib import admin
-from .models import Image, ImageOfTheDay
+from .models import Image, ImageOfTheDay, IngestJob
 from django.utils.html import format_html
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ('id', 'upload_date', 'is_approved', 'image_preview')
-    list_filter = ('is_approved', 'upload_date')
-    actions = ['approve_images']
+    list_display = ('id', 'upload_date', 'status', 'is_approved', 'image_preview')
+    list_filter = ('status', 'is_approved', 'upload_date')
+    actions = ['approve_images', 'reject_images']
     
     def image_preview(self, obj):
         """Display a thumbnail preview in admin"""
         if obj.image:
-            return format_html('<img src="{}" width="100" />', obj.image.url)
+            return format_html('<img src="{}" width="100" />', obj.thumbnail_url)
         return "No Image"
     
     image_preview.short_description = 'Preview'
     
     def approve_images(self, request, queryset):
         """Admin action to approve multiple images at once"""
-        for image in queryset:
-            image.approve()
-        self.message_user(request, f"{queryset.count()} images were approved.")
+        approved = queryset.approve()
+        self.message_user(request, f"{approved} images were approved.")
     
     approve_images.short_description = "Approve selected images"
+    
+    def reject_images(self, request, queryset):
+        """Admin action to reject multiple images at once, deleting their files"""
+        rejected = queryset.reject()
+        self.message_user(request, f"{rejected} images were rejected.")
+    
+    reject_images.short_description = "Reject selected images"
 
 @admin.register(ImageOfTheDay)
 class ImageOfTheDayAdmin(admin.ModelAdmin):
@@ -33,7 +39,13 @@ class ImageOfTheDayAdmin(admin.ModelAdmin):
     def image_preview(self, obj):
         """Display a thumbnail preview in admin"""
         if obj.image.image:
-            return format_html('<img src="{}" width="100" />', obj.image.image.url)
+            return format_html('<img src="{}" width="100" />', obj.image.thumbnail_url)
         return "No Image"
     
     image_preview.short_description = 'Preview'
+
+@admin.register(IngestJob)
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'image', 'task', 'status', 'attempts', 'created_at', 'finished_at', 'error')
+    list_filter = ('task', 'status')
+    raw_id_fields = ('image',)
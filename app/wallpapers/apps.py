@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WallpapersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wallpapers'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,623 @@
+"""Benchmarks for the hot paths of the wallpapers app
+
+Each suite is a function taking the parsed command options and returning a
+list of result rows (dicts), see the ``benchmark`` management command.
+"""
+import datetime
+import multiprocessing
+import random
+import resource
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+import imagehash
+import numpy as np
+from PIL import Image as PILImage
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from . import ingest
+from .duplicates import DuplicateIndex, hash_distances, hash_to_int
+from .metrics import QueryCounter
+
+RESOLUTIONS = {
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+}
+
+
+def _random_hash(rng):
+    return '_'.join(f'{rng.getrandbits(64):016x}' for _ in range(3))
+
+
+def _near_copy(rng, image_hash, changes):
+    """Return image_hash with `changes` random bits flipped"""
+    values = [int(h, 16) for h in image_hash.split('_')]
+    for bit in rng.sample(range(192), changes):
+        values[bit // 64] ^= 1 << (bit % 64)
+    return '_'.join(f'{value:016x}' for value in values)
+
+
+def _to_ints(image_hash):
+    return tuple(hash_to_int(h) for h in image_hash.split('_'))
+
+
+def _linear_scan(catalogue, image_hash):
+    """The per-row hex digit comparison check_for_duplicates used to do"""
+    phash, dhash, whash = image_hash.split('_')
+    for other in catalogue:
+        img_phash, img_dhash, img_whash = other.split('_')
+        phash_distance = sum(c1 != c2 for c1, c2 in zip(phash, img_phash))
+        dhash_distance = sum(c1 != c2 for c1, c2 in zip(dhash, img_dhash))
+        whash_distance = sum(c1 != c2 for c1, c2 in zip(whash, img_whash))
+        if (phash_distance + dhash_distance + whash_distance) / 3 < 5:
+            return other
+    return None
+
+
+def _timings(func, inputs):
+    timings = []
+    for value in inputs:
+        start = time.perf_counter()
+        func(value)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _summary(timings):
+    p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+    return {
+        'mean_ms': round(statistics.fmean(timings), 4),
+        'p95_ms': round(p95, 4),
+    }
+
+
+def dedup(options):
+    """Duplicate lookup cost per upload, per-row scan against the vectorized scan"""
+    rng = random.Random(options['seed'])
+    rows = []
+    for size in options['sizes']:
+        catalogue = [_random_hash(rng) for _ in range(size)]
+        queries = []
+        for i in range(options['queries']):
+            if i % 2:
+                queries.append(_random_hash(rng))
+            else:
+                queries.append(_near_copy(rng, rng.choice(catalogue), rng.randint(0, 40)))
+
+        index = DuplicateIndex()
+        start = time.perf_counter()
+        index._append(np.array([(pk, *_to_ints(h)) for pk, h in enumerate(catalogue)], dtype=np.int64))
+        load_ms = (time.perf_counter() - start) * 1000
+
+        def vectorized(query):
+            distances = hash_distances(index._hashes[:index._size], _to_ints(query))
+            return np.flatnonzero(distances <= index.max_distance)
+
+        # The per-row scan is orders of magnitude slower, a handful of
+        # queries is enough to get a stable figure
+        legacy_queries = queries[:max(1, min(len(queries), 2_000_000 // size))]
+        legacy = _timings(lambda q: _linear_scan(catalogue, q), legacy_queries)
+        scanned = _timings(vectorized, queries)
+
+        rows.append({'suite': 'dedup', 'case': 'python_scan', 'size': size, **_summary(legacy)})
+        rows.append({
+            'suite': 'dedup', 'case': 'numpy_popcount', 'size': size,
+            'load_ms': round(load_ms, 1), **_summary(scanned),
+        })
+    return rows
+
+
+def synthetic_wallpaper(size, seed=0, format='JPEG'):
+    """Encode a wallpaper-like image: smooth gradients with some noise"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    phase = rng.uniform(0, 6.28, 3)
+    channels = [
+        127 + 100 * np.sin(6 * x + 4 * y + phase[i]) + rng.normal(0, 12, (height, width)).astype(np.float32)
+        for i in range(3)
+    ]
+    pixels = np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    PILImage.fromarray(pixels).save(buffer, format, quality=90)
+    return buffer.getvalue()
+
+
+def _legacy_ingest(content):
+    """What an URL upload used to cost: verify, reopen, then three hashes on full pixels"""
+    img = PILImage.open(BytesIO(content))
+    img.verify()
+    img = PILImage.open(BytesIO(content))
+    img.size
+    img = PILImage.open(BytesIO(content))
+    return str(imagehash.phash(img)), str(imagehash.dhash(img)), str(imagehash.whash(img))
+
+
+def _single_decode_ingest(content):
+    return ingest.prepare(BytesIO(content))
+
+
+def _measure(func, content):
+    """Run func in the current process, return CPU time and peak RSS growth"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.process_time()
+    func(content)
+    cpu_ms = (time.process_time() - start) * 1000
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return cpu_ms, peak_kb
+
+
+def ingest_cost(options):
+    """CPU time and peak memory of validating and hashing one upload"""
+    rows = []
+    # Every run gets a fresh process so that the memory high-water mark of a
+    # run isn't hidden by the previous one
+    context = multiprocessing.get_context('fork')
+    for name, size in RESOLUTIONS.items():
+        content = synthetic_wallpaper(size, seed=options['seed'])
+        for case, func in (('legacy', _legacy_ingest), ('single_decode', _single_decode_ingest)):
+            cpu, peak = [], []
+            for _ in range(options['repeat']):
+                with context.Pool(1) as pool:
+                    cpu_ms, peak_kb = pool.apply(_measure, (func, content))
+                cpu.append(cpu_ms)
+                peak.append(peak_kb)
+            rows.append({
+                'suite': 'ingest', 'case': case, 'resolution': name,
+                'bytes': len(content),
+                'cpu_ms': round(statistics.median(cpu), 1),
+                'peak_rss_mb': round(statistics.median(peak) / 1024, 1),
+            })
+    return rows
+
+
+@contextmanager
+def scratch_database():
+    """Point the default database and MEDIA_ROOT at throwaway copies
+
+    Suites that need rows run against a freshly migrated test database so
+    that benchmarking never touches real data.
+    """
+    old_name = connection.settings_dict['NAME']
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        # A private cache too, suites clear it
+        caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}}
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, CACHES=caches):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+@contextmanager
+def rollback():
+    """Undo everything done in the block"""
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def create_catalogue(size, approved=True, featured=0, hashed=False, seed=0):
+    """Bulk insert size images, the first `featured` of them featured once each
+
+    With hashed=True the images get random fingerprints, so that uploads
+    are checked for duplicates against a catalogue of that size.
+    """
+    from .models import Image, ImageOfTheDay
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    images = []
+    for i in range(size):
+        image = Image(
+            image=f'wallpapers/bench_{i}.jpg', is_approved=approved,
+            approval_date=now - datetime.timedelta(minutes=i) if approved else None,
+        )
+        if hashed:
+            image.set_image_hash(_random_hash(rng).split('_'))
+            image.content_hash = f'{rng.getrandbits(256):064x}'
+        images.append(image)
+    images = Image.objects.bulk_create(images, batch_size=2000)
+    start = now.date() - datetime.timedelta(days=featured + 1)
+    ImageOfTheDay.objects.bulk_create(
+        [ImageOfTheDay(image=image, date=start + datetime.timedelta(days=i)) for i, image in enumerate(images[:featured])],
+        batch_size=2000,
+    )
+    return images
+
+
+def _legacy_select(date):
+    """The selection select_image_for_today used to run, one count per image"""
+    from random import choice
+    from .models import Image, ImageOfTheDay as cls
+
+    yesterday = date - datetime.timedelta(days=1)
+    yesterday_image_id = None
+    yesterday_image = cls.objects.filter(date=yesterday).first()
+    if yesterday_image:
+        yesterday_image_id = yesterday_image.image.id
+    approved_images = Image.objects.filter(is_approved=True)
+    if yesterday_image_id:
+        approved_images = approved_images.exclude(id=yesterday_image_id)
+    if not approved_images.exists():
+        return None
+    never_featured = approved_images.exclude(id__in=cls.objects.values_list('image__id', flat=True))
+    if never_featured.exists():
+        selected_image = choice(list(never_featured))
+    else:
+        featured_counts = {}
+        for img in approved_images:
+            featured_counts[img.id] = cls.objects.filter(image=img).count()
+        min_count = min(featured_counts.values())
+        least_featured = [img_id for img_id, count in featured_counts.items() if count == min_count]
+        selected_image = Image.objects.get(id=choice(least_featured))
+    return cls.objects.create(image=selected_image, date=date)
+
+
+def iotd_selection(options):
+    """Queries and latency of selecting the image of the day"""
+    from .models import ImageOfTheDay
+
+    rows = []
+    date = datetime.date.today()
+    for size in options['sizes']:
+        # Half featured is the common case, all featured is the one where
+        # the old selection fell back to one COUNT per image
+        for featured in (size // 2, size):
+            with rollback():
+                create_catalogue(size, featured=featured)
+                cases = [('aggregate', ImageOfTheDay.select_image_for_date)]
+                if featured < size or size <= options['legacy_limit']:
+                    cases.insert(0, ('legacy', _legacy_select))
+                for case, select in cases:
+                    timings, queries = [], 0
+                    for _ in range(options['repeat']):
+                        with rollback(), QueryCounter().capture() as counter:
+                            start = time.perf_counter()
+                            select(date)
+                            timings.append((time.perf_counter() - start) * 1000)
+                        queries = counter.count
+                    rows.append({
+                        'suite': 'iotd', 'case': case, 'size': size,
+                        'featured': featured, 'queries': queries, **_summary(timings),
+                    })
+    return rows
+
+
+def listing_queries():
+    """The listing queries and the index each of them is expected to use"""
+    from django.db.models import Count, Max
+    from .models import Image, ImageOfTheDay
+    from .views import HomeView, PendingReviewListView
+
+    return [
+        ('home', 'image_approved_idx', HomeView().get_queryset()[:HomeView.paginate_by]),
+        ('pending_review', 'image_pending_idx',
+         PendingReviewListView().get_queryset()[:PendingReviewListView.paginate_by]),
+        ('featured_days', 'iotd_image_date_idx', ImageOfTheDay.objects.filter(image_id=1).values('date')),
+        ('iotd_selection', 'iotd_image_date_idx',
+         Image.objects.filter(is_approved=True).annotate(
+             times_featured=Count('featured_days'), last_featured=Max('featured_days__date'),
+         ).values('pk', 'times_featured', 'last_featured')),
+    ]
+
+
+def query_plans(options):
+    """Check with EXPLAIN that the listing queries use their indexes
+
+    Rows have ok=False when the expected index isn't in the plan, which
+    makes the benchmark command fail.
+    """
+    rows = []
+    for size in options['sizes']:
+        with rollback():
+            create_catalogue(size, featured=size // 2)
+            create_catalogue(size // 4, approved=False)
+            # Planners only pick an index over a scan with up to date statistics
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            for case, index, queryset in listing_queries():
+                plan = queryset.explain()
+                rows.append({
+                    'suite': 'plans', 'case': case, 'size': size, 'vendor': connection.vendor,
+                    'index': index, 'ok': index in plan,
+                })
+    return rows
+
+
+def upload_latency(options):
+    """Latency and queries of a file upload, from the POST to the redirect
+
+    Captcha verification is stubbed out so that the suite runs offline.
+    """
+    from unittest import mock
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from django.urls import reverse
+    from .duplicates import duplicate_index
+
+    client = Client()
+    url = reverse('upload_image')
+    rows = []
+    for size in options['sizes']:
+        with rollback():
+            create_catalogue(size, hashed=True, seed=options['seed'])
+            for name in ('1080p', '4k'):
+                # Distinct images, none of them a duplicate of another
+                contents = [
+                    synthetic_wallpaper(RESOLUTIONS[name], seed=options['seed'] + i + 1)
+                    for i in range(options['repeat'])
+                ]
+                timings, queries = [], []
+                for content in contents:
+                    # Uploads are rolled back, bring the index back in step
+                    # with the catalogue so that only the lookup is measured
+                    duplicate_index.find((0, 0, 0))
+                    with rollback(), QueryCounter().capture() as counter, \
+                            mock.patch('wallpapers.forms.verify_captcha', return_value=True):
+                        start = time.perf_counter()
+                        response = client.post(url, {
+                            'image': SimpleUploadedFile(f'{name}.jpg', content, 'image/jpeg'),
+                            'captcha_token': 'benchmark',
+                        })
+                        timings.append((time.perf_counter() - start) * 1000)
+                    if response.status_code != 302:
+                        raise RuntimeError(f'Upload failed with status {response.status_code}')
+                    queries.append(counter.count)
+                rows.append({
+                    'suite': 'upload', 'case': name, 'size': size, 'bytes': len(contents[0]),
+                    'queries': max(queries), **_summary(timings),
+                })
+    return rows
+
+
+def _get(client, url, **headers):
+    """GET url and read the whole body, return (response, milliseconds)"""
+    start = time.perf_counter()
+    response = client.get(url, headers=headers)
+    if response.streaming:
+        b''.join(response.streaming_content)
+        response.close()
+    return response, (time.perf_counter() - start) * 1000
+
+
+def view_queries(options):
+    """Queries and latency of every page, on a cold cache then a warm one"""
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from django.test import Client
+    from django.urls import reverse
+    from .pagination import encode_cursor
+
+    anonymous, staff = Client(), Client()
+    rows = []
+    for size in options['sizes']:
+        with rollback():
+            images = create_catalogue(size, featured=min(size, 30))
+            create_catalogue(max(1, size // 10), approved=False)
+            staff.force_login(User.objects.create_user('benchmark', is_staff=True))
+            middle = images[len(images) // 2]
+            cases = [
+                ('home', anonymous, reverse('home')),
+                ('home_deep', anonymous, f"{reverse('home')}?after={encode_cursor(middle)}"),
+                ('image_detail', anonymous, reverse('image_detail', args=[middle.pk])),
+                ('image_of_the_day', anonymous, reverse('image_of_the_day')),
+                ('image_of_the_day_api', anonymous, reverse('image_of_the_day_api')),
+                ('images_api', anonymous, reverse('images_api')),
+                ('images_api_since', anonymous, f"{reverse('images_api')}?since={encode_cursor(middle)}"),
+                ('pending_review', staff, reverse('pending_review')),
+            ]
+            for case, client, url in cases:
+                cache.clear()
+                with QueryCounter().capture() as cold:
+                    response, cold_ms = _get(client, url)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{url} answered {response.status_code}')
+                timings = []
+                with QueryCounter().capture() as warm:
+                    for _ in range(options['repeat']):
+                        timings.append(_get(client, url)[1])
+                rows.append({
+                    'suite': 'views', 'case': case, 'size': size,
+                    'cold_queries': cold.count, 'cold_ms': round(cold_ms, 2),
+                    'queries': warm.count // options['repeat'], **_summary(timings),
+                })
+    return rows
+
+
+def iotd_throughput(options):
+    """Requests per second of the image of the day endpoints, one client at a time"""
+    from django.test import Client
+    from django.urls import reverse
+    from .models import ImageOfTheDay
+
+    client = Client()
+    rows = []
+    with rollback():
+        create_catalogue(1000, featured=500)
+        image = ImageOfTheDay.select_image_for_today().image
+        # The catalogue only has file names, the direct endpoint needs the bytes
+        storage = image.image.storage
+        storage.delete(image.image.name)
+        storage.save(image.image.name, BytesIO(synthetic_wallpaper(RESOLUTIONS['4k'], seed=options['seed'])))
+        etag = _get(client, reverse('image_of_the_day_direct'))[0]['ETag']
+
+        cases = [
+            ('page', reverse('image_of_the_day'), {}),
+            ('api', reverse('image_of_the_day_api'), {}),
+            ('direct', reverse('image_of_the_day_direct'), {}),
+            ('direct_not_modified', reverse('image_of_the_day_direct'), {'If-None-Match': etag}),
+            ('direct_variant', f"{reverse('image_of_the_day_direct')}?w=2560&h=1440&fmt=webp", {}),
+            ('direct_phone', f"{reverse('image_of_the_day_direct')}?w=1170&h=2532", {}),
+            ('direct_negotiated', reverse('image_of_the_day_direct'), {'Accept': 'image/avif,image/webp,*/*'}),
+        ]
+        for case, url, headers in cases:
+            # The first request fills the caches, variants get encoded
+            cold_ms = _get(client, url, **headers)[1]
+            timings = []
+            start = time.perf_counter()
+            for _ in range(options['queries']):
+                timings.append(_get(client, url, **headers)[1])
+            elapsed = time.perf_counter() - start
+            rows.append({
+                'suite': 'throughput', 'case': case, 'requests': options['queries'],
+                'rps': round(options['queries'] / elapsed, 1), 'cold_ms': round(cold_ms, 2), **_summary(timings),
+            })
+    return rows
+
+
+# Tables standing in for the rows written by an upload, on a database file of
+# their own so that the journal mode of one run doesn't carry over
+_CONTENTION_SCHEMA = (
+    'CREATE TABLE upload (id INTEGER PRIMARY KEY, content_hash TEXT UNIQUE, uploaded REAL)',
+    'CREATE TABLE job (id INTEGER PRIMARY KEY, upload_id INTEGER, state TEXT)',
+)
+
+
+def _contention_database(settings_dict):
+    """Connection to settings_dict under the 'contention' alias"""
+    from django.db import connections
+
+    connections.settings['contention'] = settings_dict
+    # The handler keeps the connection of the previous run otherwise
+    if hasattr(connections._connections, 'contention'):
+        del connections['contention']
+    return connections['contention']
+
+
+def _contention_worker(settings_dict, role, count, start_at):
+    """Upload (or list) count times from a forked process
+
+    Returns (role, milliseconds of every successful operation, errors).
+    """
+    import os
+    from django.db import DatabaseError
+
+    database = _contention_database(settings_dict)
+    time.sleep(max(0, start_at - time.time()))
+    timings, errors = [], 0
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            if role == 'writer':
+                # Like a form upload: a duplicate check, then the inserts
+                with transaction.atomic(using='contention'), database.cursor() as cursor:
+                    content_hash = f'{os.getpid()}-{i}'
+                    cursor.execute('SELECT COUNT(*) FROM upload WHERE content_hash = %s', [content_hash])
+                    cursor.execute('INSERT INTO upload (content_hash, uploaded) VALUES (%s, %s)',
+                                   [content_hash, time.time()])
+                    cursor.execute("INSERT INTO job (upload_id, state) VALUES (%s, 'queued')", [cursor.lastrowid])
+            else:
+                with database.cursor() as cursor:
+                    cursor.execute('SELECT id, content_hash FROM upload ORDER BY uploaded DESC LIMIT 24')
+                    cursor.fetchall()
+        except DatabaseError:
+            errors += 1
+            continue
+        timings.append((time.perf_counter() - start) * 1000)
+    database.close()
+    return role, timings, errors
+
+
+def write_contention(options):
+    """Uploads per second and "database is locked" errors during a burst
+
+    Every writer process uploads --queries times at once while a reader keeps
+    listing, against SQLite as it comes (rollback journal, deferred
+    transactions) and with the SQLITE_OPTIONS of the settings.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from django.conf import settings
+    from django.db import connections
+
+    if connection.vendor != 'sqlite':
+        raise RuntimeError('The db suite measures SQLite, DATABASE_URL must be unset')
+
+    profiles = {'default': {}, 'tuned': settings.SQLITE_OPTIONS}
+    context = multiprocessing.get_context('fork')
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for writers in options['writers']:
+            for profile, sqlite_options in profiles.items():
+                settings_dict = {
+                    **connection.settings_dict, 'NAME': f'{directory}/{profile}-{writers}.sqlite3',
+                    'OPTIONS': sqlite_options, 'CONN_MAX_AGE': None,
+                }
+                database = _contention_database(settings_dict)
+                with database.cursor() as cursor:
+                    for statement in _CONTENTION_SCHEMA:
+                        cursor.execute(statement)
+
+                # Forked workers must not share the database connections
+                connections.close_all()
+                roles = ['writer'] * writers + ['reader']
+                start_at = time.time() + 0.5
+                with ProcessPoolExecutor(len(roles), mp_context=context) as pool:
+                    results = list(pool.map(
+                        _contention_worker, [settings_dict] * len(roles), roles,
+                        [options['queries']] * len(roles), [start_at] * len(roles),
+                    ))
+                elapsed = time.time() - start_at
+
+                writes = [t for role, timings, _ in results if role == 'writer' for t in timings]
+                reads = [t for role, timings, _ in results if role == 'reader' for t in timings]
+                summary = _summary(writes) if writes else {'mean_ms': None, 'p95_ms': None}
+                rows.append({
+                    'suite': 'db', 'case': profile, 'writers': writers,
+                    'uploads': len(writes),
+                    'errors': sum(errors for role, _, errors in results if role == 'writer'),
+                    'rps': round(len(writes) / elapsed, 1), **summary,
+                    'read_p95_ms': _summary(reads)['p95_ms'] if reads else None,
+                })
+    return rows
+
+
+SUITES = {
+    'dedup': dedup,
+    'ingest': ingest_cost,
+    'iotd': iotd_selection,
+    'plans': query_plans,
+    'upload': upload_latency,
+    'views': view_queries,
+    'throughput': iotd_throughput,
+    'db': write_contention,
+}
+
+# Suites run inside scratch_database()
+DATABASE_SUITES = {'iotd', 'plans', 'upload', 'views', 'throughput'}
+
+# Result columns that are measurements, the others identify the row
+METRIC_SUFFIXES = ('_ms', '_mb', 'queries', 'rps', 'uploads', 'errors')
+
+
+def is_metric(key):
+    return key.endswith(METRIC_SUFFIXES)
+
+
+def compare(rows, baseline):
+    """Add the relative change of every metric against a baseline run
+
+    Rows are matched on their non-metric columns, e.g. suite, case and size.
+    """
+    def identity(row):
+        return tuple((key, value) for key, value in row.items() if not is_metric(key))
+
+    previous = {identity(row): row for row in baseline}
+    for row in rows:
+        before = previous.get(identity(row))
+        if before is None:
+            yield row
+            continue
+        row = dict(row)
+        for key, value in list(row.items()):
+            if is_metric(key) and before.get(key):
+                row[f'{key}_change'] = f'{(value - before[key]) / before[key]:+.1%}'
+        yield row
@@ -0,0 +1,112 @@
+"""Response caching of the public pages
+
+Anonymous visitors all get the same home page, image pages and image of the
+day, which only change when an image is approved, featured or deleted, or
+when the day changes. Their responses are cached under a key made of:
+
+- a content version, bumped by invalidate() whenever the gallery changes
+  (see signals.py and ImageQuerySet), which makes every cached page stale
+  at once without having to know their keys,
+- today's date, for the image of the day,
+- the view and the full URL.
+
+Hits and misses are counted per view, see cache_stats().
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import metrics
+
+VERSION_CACHE_KEY = 'wallpapers:content-version'
+
+
+def _seed_version():
+    # The cache may evict the version like any other key. Starting again
+    # from the clock, instead of 1, never reuses a version whose pages are
+    # still cached.
+    cache.add(VERSION_CACHE_KEY, time.time_ns(), None)
+
+
+def content_version():
+    """Current version of the public content"""
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        _seed_version()
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def invalidate():
+    """Make every cached page stale, in every process sharing the cache"""
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        _seed_version()
+
+
+def cache_stats():
+    """Hits and misses so far in this process, as {(view, 'hit' or 'miss'): count}"""
+    return {
+        (dict(labels)['view'], dict(labels)['outcome']): value
+        for (name, labels), value in metrics.snapshot()['counters'].items()
+        if name == 'page_cache_requests_total'
+    }
+
+
+def _count(view, outcome):
+    metrics.increment('page_cache_requests_total', view=view, outcome=outcome)
+
+
+def _is_cacheable(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.user.is_authenticated:
+        return False
+    # Flash messages (e.g. after an upload) are shown once, on this page
+    return not len(messages.get_messages(request))
+
+
+def cache_key(view, request):
+    url = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'wallpapers:page:{content_version()}:{timezone.now().date().isoformat()}:{view}:{url}'
+
+
+def cache_for_anonymous(view):
+    """Decorator serving a view's responses to anonymous visitors from the cache
+
+    Only successful responses that don't set cookies are stored. The
+    X-Cache response header tells whether the response was a hit.
+
+    Args:
+        view: name of the view in the cache keys and the hit/miss counters
+    """
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if not _is_cacheable(request):
+                return view_func(request, *args, **kwargs)
+
+            key = cache_key(view, request)
+            response = cache.get(key)
+            if response is not None:
+                _count(view, 'hit')
+                response['X-Cache'] = 'HIT'
+                return response
+
+            _count(view, 'miss')
+            response = view_func(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            if response.status_code == 200 and not response.cookies and not response.streaming:
+                cache.set(key, response, settings.PAGE_CACHE_TIMEOUT)
+            response['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+    return decorator
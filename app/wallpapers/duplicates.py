@@ -0,0 +1,164 @@
+import threading
+import time
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Max, Q, Sum
+
+# Two images are considered duplicates when their phash, dhash and whash
+# differ in at most 30 bits in total out of 192, i.e. about 10 bits per hash.
+MAX_DISTANCE = 30
+
+HASH_FIELDS = ('phash', 'dhash', 'whash')
+
+# Bumped by DuplicateIndex.invalidate() so that every process reloads
+GENERATION_CACHE_KEY = 'wallpapers:duplicate-index:generation'
+
+# Popcount fallback for NumPy < 2.0, which has no bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hash_to_int(value):
+    """Convert a 64-bit hash (hex string or ImageHash) to a signed integer
+
+    The value is stored as two's complement so that it fits in a signed
+    64-bit BigIntegerField, the bit pattern is left untouched.
+    """
+    value = int(str(value), 16)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def popcount(array):
+    """Number of set bits of every element of an unsigned 64-bit array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(array)
+    counts = _POPCOUNT_TABLE[array.view(np.uint8)]
+    return counts.reshape(array.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hash_distances(hashes, query):
+    """Hamming distance in bits between each row of hashes and the query
+
+    Args:
+        hashes: (N, 3) uint64 array of phash, dhash and whash
+        query: sequence of three signed integers
+    """
+    query = np.array(query, dtype=np.int64).view(np.uint64)
+    return popcount(hashes ^ query).sum(axis=1, dtype=np.uint32)
+
+
+class DuplicateIndex:
+    """Process-wide in-memory copy of the perceptual hashes of all images
+
+    The hashes are kept in a single (N, 3) uint64 array so that a duplicate
+    lookup is one vectorized XOR and popcount over the whole catalogue. The
+    array is loaded lazily from the database and kept up to date
+    incrementally: each lookup compares the number of hashed rows, the sum
+    of their primary keys and the highest one with what has been loaded,
+    only fetches the new rows and falls back to a full reload when anything
+    else changed, e.g. queued uploads hashed out of primary key order while
+    others were rejected. Re-hashing existing rows can't be detected that
+    way and needs a call to invalidate().
+    """
+
+    def __init__(self, max_distance=MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = np.empty((0, 3), dtype=np.uint64)
+        self._pks = np.empty(0, dtype=np.int64)
+        self._size = 0
+        self._pk_sum = 0
+        self._last_pk = None
+        self._generation = None
+
+    def invalidate(self):
+        """Make every process reload the hashes on its next lookup
+
+        Other processes only get notified through a cache backend they
+        share with this one.
+        """
+        try:
+            cache.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            # Evicted: start again from the clock so that no process can be
+            # left holding the same generation
+            cache.add(GENERATION_CACHE_KEY, time.time_ns(), None)
+        with self._lock:
+            self._last_pk = None
+
+    def _rows(self, queryset):
+        rows = queryset.filter(phash__isnull=False).values_list('pk', *HASH_FIELDS)
+        return np.array(list(rows), dtype=np.int64).reshape(-1, 4)
+
+    def _append(self, rows):
+        needed = self._size + len(rows)
+        if needed > len(self._pks):
+            # Grow geometrically so appending one upload at a time stays cheap
+            capacity = max(needed, 2 * len(self._pks), 1024)
+            hashes = np.empty((capacity, 3), dtype=np.uint64)
+            hashes[:self._size] = self._hashes[:self._size]
+            pks = np.empty(capacity, dtype=np.int64)
+            pks[:self._size] = self._pks[:self._size]
+            self._hashes, self._pks = hashes, pks
+        self._hashes[self._size:needed] = rows[:, 1:].view(np.uint64)
+        self._pks[self._size:needed] = rows[:, 0]
+        self._pk_sum += int(rows[:, 0].sum())
+        self._size = needed
+
+    def _sync(self):
+        from .models import Image
+
+        generation = cache.get(GENERATION_CACHE_KEY, 0)
+        if generation != self._generation:
+            self._last_pk = None
+            self._generation = generation
+
+        queryset = Image.objects.all()
+        # Rows still waiting for their hash are left out of last_pk so they
+        # get picked up incrementally once the hash is written
+        stats = queryset.aggregate(
+            hashed=Count('phash'),
+            pk_sum=Sum('pk', filter=Q(phash__isnull=False)),
+            last_pk=Max('pk', filter=Q(phash__isnull=False)),
+        )
+        last_pk = stats['last_pk'] or 0
+
+        if self._last_pk is not None and last_pk > self._last_pk:
+            self._append(self._rows(queryset.filter(pk__gt=self._last_pk, pk__lte=last_pk)))
+            self._last_pk = last_pk
+
+        # The count alone misses a row hashed below last_pk while another
+        # lost its hash, the sum of the primary keys catches it
+        if self._last_pk is None or self._size != stats['hashed'] or self._pk_sum != (stats['pk_sum'] or 0):
+            self._size = self._pk_sum = 0
+            self._append(self._rows(queryset.filter(pk__lte=last_pk)))
+            self._last_pk = last_pk
+
+    def find(self, hashes, exclude_pk=None):
+        """Return the closest existing Image within max_distance, or None
+
+        Args:
+            hashes: (phash, dhash, whash) as signed integers
+            exclude_pk: primary key of the image being checked, if saved
+        """
+        from .models import Image
+
+        with self._lock:
+            self._sync()
+            distances = hash_distances(self._hashes[:self._size], hashes)
+            matches = np.flatnonzero(distances <= self.max_distance)
+            matches = matches[np.lexsort((self._pks[matches], distances[matches]))]
+            pks = [int(pk) for pk in self._pks[matches] if pk != exclude_pk]
+
+        if not pks:
+            return None
+        # The loaded hashes may lag behind deletions, only return rows that
+        # still exist
+        images = Image.objects.in_bulk(pks)
+        for pk in pks:
+            if pk in images:
+                return images[pk]
+        return None
+
+
+duplicate_index = DuplicateIndex()
@@ -1,16 +1,11 @@
 from django import forms
-from .models import Image
-import requests
-from io import BytesIO
+from django.conf import settings
+from .models import Image, IngestJob, duplicate_error
 from django.core.files.images import ImageFile
-from PIL import Image as PILImage
+from . import ingest, metrics
 from .utils import verify_captcha
-from django.utils import timezone
 from django.core.exceptions import ValidationError
 
-ASPECT_RATIO = 16 / 9
-ASPECT_RATIO_MARGIN = 0.3
-
 class ImageUploadForm(forms.ModelForm):
     """Form for uploading images from a file"""
     captcha_token = forms.CharField(widget=forms.HiddenInput(), required=True)
@@ -22,24 +17,18 @@ class ImageUploadForm(forms.ModelForm):
     def clean_image(self):
         image = self.cleaned_data.get('image')
         if image:
-            # Check image dimensions using PIL
-            img = PILImage.open(image)
-            width, height = img.size
-            
-            # Check minimum resolution (1920x1080)
-            if width < 1920 or height < 1080:
-                raise forms.ValidationError(
-                    f'Image resolution is too low ({width}x{height}). Minimum required is 1920x1080.'
-                )
-            
-            # Check aspect ratio (16:9)
-            aspect_ratio = width / height
-            
-            # Allow for a small margin of error
-            if abs(aspect_ratio - ASPECT_RATIO) > ASPECT_RATIO_MARGIN:
-                raise forms.ValidationError(
-                    f'Image aspect ratio is {aspect_ratio:.2f}, but must be 16:9 (1.78) +- {ASPECT_RATIO_MARGIN}.'
-                )
+            # Exact copies are refused before any decoding, hashing the
+            # bytes is far cheaper and also gives the file its name
+            self.instance.content_hash = ingest.content_hash(image)
+            duplicate_image = self.instance.find_exact_duplicate()
+            if duplicate_image is not None:
+                raise duplicate_error(duplicate_image)
+        # With INGEST_ASYNC the checks and hashing are left to the worker
+        if image and not settings.INGEST_ASYNC:
+            # Check the resolution and aspect ratio from the header, then
+            # hash the pixels from a single decode so that Image.save can
+            # check for duplicates without reading the upload again
+            self.instance.set_image_hash(ingest.prepare(image))
                 
         return image
     
@@ -57,9 +46,13 @@ class ImageUploadForm(forms.ModelForm):
         
     def save(self, commit=True):
         instance = super().save(commit=False)
+        if settings.INGEST_ASYNC:
+            instance.status = Image.Status.PROCESSING
         try:
             if commit:
                 instance.save()
+                if settings.INGEST_ASYNC:
+                    IngestJob.objects.create(image=instance)
             return instance
         except ValidationError as e:
             # Add the error to the form
@@ -84,69 +77,46 @@ class ImageURLForm(forms.Form):
         
         return cleaned_data
     
+    @metrics.timed('url_upload_clean')
     def clean_image_url(self):
-        """Validate that the URL points to an image and meets resolution/aspect ratio requirements"""
+        """Validate that the URL points to an image and meets resolution/aspect ratio requirements
+        
+        The image is downloaded and fingerprinted once here, save() reuses both.
+        With INGEST_ASYNC all of this is left to the worker.
+        """
         url = self.cleaned_data['image_url']
-        try:
-            response = requests.get(url, stream=True, timeout=10)
-            response.raise_for_status()
-            
-            # Open the image to check dimensions
-            img = PILImage.open(BytesIO(response.content))
-            img.verify()  # Verify it's an image
-            
-            # Re-open the image after verify() to get dimensions
-            img = PILImage.open(BytesIO(response.content))
-            width, height = img.size
-            
-            # Check minimum resolution (1920x1080)
-            if width < 1920 or height < 1080:
-                raise forms.ValidationError(
-                    f'Image resolution is too low ({width}x{height}). Minimum required is 1920x1080.'
-                )
-            
-            # Check aspect ratio (16:9)
-            aspect_ratio = width / height
-            
-            # Allow for a small margin of error
-            if abs(aspect_ratio - ASPECT_RATIO) > ASPECT_RATIO_MARGIN:
-                raise forms.ValidationError(
-                    f'Image aspect ratio is {aspect_ratio:.2f}, but must be 16:9 (1.78) +- {ASPECT_RATIO_MARGIN}.'
-                )
-                
+        if settings.INGEST_ASYNC:
             return url
-        except requests.exceptions.RequestException as e:
-            raise forms.ValidationError(f"Error downloading image: {e}")
-        except forms.ValidationError:
-            # Re-raise validation errors
+        
+        content = ingest.download(url)
+        try:
+            self.content_hash = ingest.content_hash(content)
+            duplicate_image = Image(content_hash=self.content_hash).find_exact_duplicate()
+            if duplicate_image is not None:
+                raise duplicate_error(duplicate_image)
+            self.image_hashes = ingest.prepare(content)
+        except ValidationError:
+            content.close()
             raise
-        except Exception as e:
-            raise forms.ValidationError(f"Invalid image URL: {e}")
+        self.image_content = content
+        return url
     
+    @metrics.timed('url_upload_save')
     def save(self):
-        """Download the image from URL and create an Image instance"""
+        """Create an Image instance from the downloaded image"""
         url = self.cleaned_data.get('image_url')
         
-        # Download the image
-        response = requests.get(url, stream=True, timeout=10)
-        response.raise_for_status()
-        
-        # Extract filename from URL
-        import os
-        from urllib.parse import urlparse
-        
-        parsed_url = urlparse(url)
-        filename = os.path.basename(parsed_url.path)
-        
-        # If filename is empty or invalid, use a generic name
-        if not filename or '.' not in filename:
-            filename = f"image_from_url_{timezone.now().strftime('%Y%m%d%H%M%S')}.jpg"
+        if settings.INGEST_ASYNC:
+            # Queue the URL, the worker downloads and processes it
+            image = Image.objects.create(source_url=url, status=Image.Status.PROCESSING)
+            IngestJob.objects.create(image=image)
+            return image
         
         # Create Image instance
-        img_io = BytesIO(response.content)
-        img_file = ImageFile(img_io, name=filename)
+        img_file = ImageFile(self.image_content, name=ingest.filename_from_url(url))
         
-        image = Image(image=img_file, source_url=url)
+        image = Image(image=img_file, source_url=url, content_hash=self.content_hash)
+        image.set_image_hash(self.image_hashes)
         try:
             image.save()
             return image
@@ -0,0 +1,201 @@
+"""Validation and fingerprinting of incoming wallpapers
+
+Both upload forms and the Image model go through this module so that an
+upload is checked from its header alone and its pixels are decoded only
+once, the decoded buffer being shared by the three perceptual hashers.
+"""
+import hashlib
+import os
+import tempfile
+from urllib.parse import urlparse
+
+import imagehash
+import requests
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from . import metrics
+
+MIN_WIDTH = 1920
+MIN_HEIGHT = 1080
+ASPECT_RATIO = 16 / 9
+ASPECT_RATIO_MARGIN = 0.3
+
+# JPEGs are decoded straight to grayscale at a reduced scale no smaller than
+# this, which is more than the hashers need (whash works on at most 1024px)
+# and spares decoding every pixel of 4K/8K wallpapers
+HASH_DECODE_SIZE = (MIN_WIDTH, MIN_HEIGHT)
+
+# Version of the fingerprint computed by fingerprint(), stored with the
+# hashes. Bump it whenever the way hashes are computed changes, then run
+# `manage.py recompute_hashes` to bring existing images up to date.
+#   1: hashes computed from the full resolution image
+#   2: hashes computed from a single reduced grayscale decode
+HASH_VERSION = 2
+
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Downloads are kept in memory up to this size, then spooled to disk
+SPOOL_MAX_MEMORY = 2 * 1024 * 1024
+# The header is looked for in this many first bytes, the dimensions of any
+# common format are found well before that
+HEADER_PROBE_BYTES = 512 * 1024
+
+# Shared by every download of the process so connections are pooled and
+# reused across fetches
+session = requests.Session()
+
+
+def open_image(fileobj):
+    """Open an image, only its header is read at this point"""
+    fileobj.seek(0)
+    try:
+        return PILImage.open(fileobj)
+    except Exception:
+        raise ValidationError("Invalid image: the file format is not recognized.")
+
+
+@metrics.timed('content_hash')
+def content_hash(fileobj):
+    """SHA-256 hex digest of the bytes of a file, which names it in storage"""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(DOWNLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def _probe_header(spool):
+    """Check the dimensions as soon as enough of the download is there
+
+    Returns:
+        bool: True once the header has been read and validated, False if
+              more data is needed
+    """
+    # The size downloaded so far, tell() after a failed open() is only
+    # where PIL stopped reading
+    downloaded = spool.seek(0, os.SEEK_END)
+    spool.seek(0)
+    try:
+        img = PILImage.open(spool)
+    except Exception:
+        if downloaded < HEADER_PROBE_BYTES:
+            return False
+        raise ValidationError("Invalid image: the file format is not recognized.")
+    finally:
+        spool.seek(0, os.SEEK_END)
+    validate_dimensions(img)
+    return True
+
+
+@metrics.timed('download')
+def download(url):
+    """Stream an image from url into a temporary file
+
+    The download is aborted as soon as it goes over settings.MAX_DOWNLOAD_BYTES
+    (checked upfront against Content-Length when the server sends it) or as
+    soon as the image header shows the resolution is too low.
+
+    Returns:
+        SpooledTemporaryFile: the downloaded bytes, rewound
+    Raises:
+        ValidationError: if the download fails or the image is rejected
+    """
+    max_bytes = settings.MAX_DOWNLOAD_BYTES
+    too_large = ValidationError(f"Image is too large, the maximum size is {max_bytes // (1024 * 1024)} MB.")
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > max_bytes:
+                raise too_large
+            
+            header_checked = False
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+                if spool.tell() > max_bytes:
+                    raise too_large
+                if not header_checked:
+                    header_checked = _probe_header(spool)
+    except requests.exceptions.RequestException as e:
+        spool.close()
+        raise ValidationError(f"Error downloading image: {e}")
+    except ValidationError:
+        spool.close()
+        raise
+    
+    spool.seek(0)
+    return spool
+
+
+def filename_from_url(url):
+    """Name to store an image downloaded from url under"""
+    filename = os.path.basename(urlparse(url).path)
+    
+    # If filename is empty or invalid, use a generic name
+    if not filename or '.' not in filename:
+        filename = f"image_from_url_{timezone.now().strftime('%Y%m%d%H%M%S')}.jpg"
+    return filename
+
+
+def validate_dimensions(img):
+    """Check the resolution and aspect ratio from the image header"""
+    width, height = img.size
+    
+    # Check minimum resolution (1920x1080)
+    if width < MIN_WIDTH or height < MIN_HEIGHT:
+        raise ValidationError(
+            f'Image resolution is too low ({width}x{height}). Minimum required is {MIN_WIDTH}x{MIN_HEIGHT}.'
+        )
+    
+    # Check aspect ratio (16:9), allowing for a small margin of error
+    aspect_ratio = width / height
+    if abs(aspect_ratio - ASPECT_RATIO) > ASPECT_RATIO_MARGIN:
+        raise ValidationError(
+            f'Image aspect ratio is {aspect_ratio:.2f}, but must be 16:9 (1.78) +- {ASPECT_RATIO_MARGIN}.'
+        )
+
+
+@metrics.timed('decode')
+def decode(img):
+    """Decode the pixels of img once, as the grayscale buffer the hashers use
+
+    Raises ValidationError for truncated or corrupt files, which replaces
+    the separate verify() pass.
+    """
+    img.draft('L', HASH_DECODE_SIZE)
+    try:
+        return img.convert('L')
+    except Exception as e:
+        raise ValidationError(f"Invalid image: {e}")
+
+
+def fingerprint(img):
+    """Return the (phash, dhash, whash) hex strings of a PIL image"""
+    gray = decode(img)
+    hashes = []
+    for name, hasher in (('phash', imagehash.phash), ('dhash', imagehash.dhash), ('whash', imagehash.whash)):
+        with metrics.span(name):
+            hashes.append(str(hasher(gray)))
+    return tuple(hashes)
+
+
+def prepare(fileobj):
+    """Validate an uploaded image file and compute its fingerprint
+
+    Returns:
+        tuple: (phash, dhash, whash) hex strings
+    Raises:
+        ValidationError: if the file isn't an image or doesn't meet the
+                         resolution/aspect ratio requirements
+    """
+    img = open_image(fileobj)
+    validate_dimensions(img)
+    hashes = fingerprint(img)
+    fileobj.seek(0)
+    return hashes
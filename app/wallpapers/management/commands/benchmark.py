@@ -0,0 +1,69 @@
+import datetime
+import json
+import platform
+import subprocess
+from contextlib import nullcontext
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from wallpapers.benchmarks import DATABASE_SUITES, SUITES, compare, scratch_database
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Runs benchmarks against the hot paths of the wallpapers app'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='*', choices=sorted(SUITES), help='Suites to run (default: all)')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Catalogue sizes to benchmark')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Number of lookups per catalogue size, or of requests per endpoint')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per case for the per-upload suites')
+        parser.add_argument('--legacy-limit', type=int, default=10000,
+                            help='Largest catalogue to run the legacy (per-row) implementations on')
+        parser.add_argument('--writers', type=int, nargs='+', default=[1, 4, 16],
+                            help='Numbers of concurrent uploading processes for the db suite')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic data')
+        parser.add_argument('--output', help='Also write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of an earlier run to show the changes against')
+
+    def handle(self, *args, **options):
+        suites = options['suites'] or sorted(SUITES)
+        baseline = []
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+
+        database = scratch_database() if DATABASE_SUITES.intersection(suites) else nullcontext()
+        results = []
+        failed = []
+        with database:
+            for name in suites:
+                rows = SUITES[name](options)
+                results.extend(rows)
+                for row in compare(rows, baseline):
+                    self.stdout.write('  '.join(f'{key}={value}' for key, value in row.items()))
+                    if row.get('ok') is False:
+                        failed.append(f"{row['suite']}:{row['case']}")
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'revision': git_revision(),
+                    'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'options': {key: options[key] for key in ('suites', 'sizes', 'queries', 'repeat', 'writers', 'seed')},
+                    'results': results,
+                }, f, indent=2)
+        if failed:
+            raise CommandError(f"Failed checks: {', '.join(failed)}")
@@ -0,0 +1,63 @@
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = ('Runs a local stand-in for the cap server so that uploads can be load tested offline, '
+            'point CAPTCHA_VERIFY_URL at http://<host>:<port>/siteverify')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8089, help='Port to listen on (default: 8089)')
+        parser.add_argument('--delay', type=float, default=0,
+                            help='Milliseconds to wait before answering, to simulate a slow server')
+        parser.add_argument('--failure-rate', type=float, default=0,
+                            help='Fraction of requests answered with a 503, to exercise the circuit breaker')
+
+    def handle(self, *args, **options):
+        delay = options['delay'] / 1000
+        failure_rate = options['failure_rate']
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real server, so connection reuse is measured
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes, don't let Nagle's
+            # algorithm hold the body back on a kept-alive connection
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if delay:
+                    time.sleep(delay)
+                if random.random() < failure_rate:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                try:
+                    token = json.loads(body).get('response', '')
+                except ValueError:
+                    token = ''
+                # Any token is valid except 'invalid', to test rejections
+                payload = json.dumps({'success': bool(token) and token != 'invalid'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((options['host'], options['port']), Handler)
+        self.stdout.write(f"Captcha stub listening on http://{options['host']}:{options['port']}/siteverify")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from wallpapers import caching
+from wallpapers.models import Image
+from wallpapers.renditions import create_placeholder
+
+
+class Command(BaseCommand):
+    help = (
+        'Computes the placeholder and dominant colour of images that do not have them yet, '
+        'from their smallest rendition (or their original when they have none)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Also include images pending review')
+        parser.add_argument('--force', action='store_true', help='Recompute placeholders that already exist')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Images read from the database at once')
+
+    def handle(self, *args, **options):
+        images = Image.objects.all() if options['all'] else Image.objects.filter(is_approved=True)
+        images = images.exclude(image='').order_by('pk')
+        if not options['force']:
+            images = images.filter(placeholder__isnull=True)
+        generated = failed = 0
+        last_pk = 0
+
+        while True:
+            chunk = list(images.filter(pk__gt=last_pk).only('pk', 'image', 'renditions')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+
+            done = []
+            for image in chunk:
+                try:
+                    image.placeholder, image.dominant_color = create_placeholder(image)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Image {image.pk}: {e}')
+                    continue
+                done.append(image)
+            Image.objects.bulk_update(done, ['placeholder', 'dominant_color'])
+            generated += len(done)
+            self.stdout.write(f'  {generated + failed} images done (up to id {last_pk})')
+
+        if generated:
+            # Cached pages were rendered without the placeholders
+            caching.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Generated placeholders for {generated} images ({failed} failed)'))
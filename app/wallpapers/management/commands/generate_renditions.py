@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from wallpapers.models import Image
+
+class Command(BaseCommand):
+    help = 'Generates the gallery renditions of images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Also include images pending review')
+        parser.add_argument('--force', action='store_true', help='Regenerate renditions that already exist')
+
+    def handle(self, *args, **options):
+        images = Image.objects.all() if options['all'] else Image.objects.filter(is_approved=True)
+        if not options['force']:
+            images = images.filter(renditions={})
+
+        generated = failed = 0
+        for image in images.order_by('pk').iterator():
+            try:
+                image.generate_renditions()
+                generated += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'Image {image.pk}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Generated renditions for {generated} images ({failed} failed)'))
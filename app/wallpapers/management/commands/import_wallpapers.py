@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from wallpapers import caching, ingest
+from wallpapers.duplicates import MAX_DISTANCE, duplicate_index, hash_distances, hash_to_int
+from wallpapers.models import Image, get_upload_path
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def fingerprint(source):
+    """Validate and hash one file or URL, run in a worker process
+
+    Returns:
+        tuple: (source, local path, SHA-256, hashes, error). URLs are
+               downloaded to a temporary file whose path is returned, hashes
+               is None when the image was rejected and error says why.
+    """
+    path = source
+    try:
+        if source.startswith(('http://', 'https://')):
+            with ingest.download(source) as content, tempfile.NamedTemporaryFile(delete=False) as f:
+                shutil.copyfileobj(content, f)
+                path = f.name
+        with open(path, 'rb') as f:
+            return source, path, ingest.content_hash(f), ingest.prepare(f), None
+    except ValidationError as e:
+        return source, path, None, None, ' '.join(e.messages)
+    except Exception as e:
+        return source, path, None, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Imports wallpapers in bulk from a directory or a file listing one URL per line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory to import recursively, or text file of image URLs')
+        parser.add_argument('--approve', action='store_true', help='Approve the imported images right away')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of hashing processes (default: number of CPUs)')
+        parser.add_argument('--batch-size', type=int, default=100, help='Images inserted per bulk_create')
+
+    def collect(self, source):
+        if os.path.isdir(source):
+            return sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(source)
+                for name in names
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        if os.path.isfile(source):
+            with open(source) as f:
+                return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        raise CommandError(f'{source} is neither a directory nor a file')
+
+    def handle(self, *args, **options):
+        sources = self.collect(options['source'])
+        self.stdout.write(f'Importing {len(sources)} images with {options["workers"]} workers...')
+
+        self.approve = options['approve']
+        self.batch = []
+        self.imported = 0
+        rejected = {}
+        start = time.perf_counter()
+
+        # Forked workers must not share the database connection
+        connection.close()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(options['workers'], mp_context=context) as pool:
+            for source, path, content_hash, hashes, error in pool.map(fingerprint, sources, chunksize=4):
+                try:
+                    if error is None:
+                        error = self.add(source, path, content_hash, hashes)
+                finally:
+                    if path != source and os.path.exists(path):
+                        os.remove(path)
+                if error:
+                    rejected[source] = error
+                if len(self.batch) >= options['batch_size']:
+                    self.flush()
+        self.flush()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.imported} images, rejected {len(rejected)}, '
+            f'in {elapsed:.1f}s ({len(sources) / elapsed if elapsed else 0:.1f} images/s)'
+        ))
+        for reason, count in Counter(rejected.values()).most_common():
+            self.stdout.write(f'  {count:6d}  {reason}')
+        if options['verbosity'] > 1:
+            for source, reason in rejected.items():
+                self.stdout.write(f'{source}: {reason}')
+        if self.approve and self.imported:
+            self.stdout.write('Run `manage.py generate_renditions` to create the gallery renditions.')
+
+    def add(self, source, path, content_hash, hashes):
+        """Queue a validated image for insertion, return an error if it's a duplicate"""
+        ints = [hash_to_int(h) for h in hashes]
+
+        # Exact copy, found from the bytes alone...
+        if any(image.content_hash == content_hash for image in self.batch):
+            return 'Duplicate of another imported image'
+        if Image.objects.filter(content_hash=content_hash).exists():
+            return 'Duplicate of an existing image'
+        # ...duplicate of an image already in the database...
+        if duplicate_index.find(ints) is not None:
+            return 'Duplicate of an existing image'
+        # ...or of one from the current, not yet inserted, batch
+        if self.batch:
+            pending = np.array([[image.phash, image.dhash, image.whash] for image in self.batch], dtype=np.int64)
+            if (hash_distances(pending.view(np.uint64), ints) <= MAX_DISTANCE).any():
+                return 'Duplicate of another imported image'
+
+        image = Image(
+            content_hash=content_hash,
+            source_url=source if source != path else None,
+            is_approved=self.approve,
+            approval_date=timezone.now() if self.approve else None,
+        )
+        image.set_image_hash(hashes)
+        filename = ingest.filename_from_url(source) if source != path else os.path.basename(path)
+        with open(path, 'rb') as f:
+            image.image = image.image.storage.save(get_upload_path(image, filename), File(f))
+        self.batch.append(image)
+        return None
+
+    def flush(self):
+        """Insert the current batch, its images then count as existing ones"""
+        if self.batch:
+            Image.objects.bulk_create(self.batch)
+            # bulk_create sends no post_save, approved imports must still
+            # show up on the cached pages
+            if self.approve:
+                caching.invalidate()
+            self.imported += len(self.batch)
+            self.batch = []
@@ -0,0 +1,61 @@
+import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from wallpapers.models import IngestJob
+
+class Command(BaseCommand):
+    help = (
+        'Processes queued uploads (validation, hashing and duplicate check) and the renditions '
+        'of images approved in bulk, see INGEST_ASYNC'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=os.cpu_count() or 1,
+                            help='Number of jobs processed in parallel (default: number of CPUs)')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait before checking an empty queue again')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which a running job is considered abandoned and requeued')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of waiting for new jobs')
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        requeued = IngestJob.requeue_stale(datetime.timedelta(seconds=options['stale_after']))
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Requeued {requeued} abandoned jobs'))
+
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            workers = [pool.submit(self.work, options) for _ in range(options['concurrency'])]
+            try:
+                for worker in workers:
+                    worker.result()
+            except KeyboardInterrupt:
+                self.stdout.write('Stopping once the running jobs are done...')
+                self.stop.set()
+
+    def work(self, options):
+        """Process jobs until stopped (or until the queue is empty with --once)"""
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                job = IngestJob.claim()
+                if job is None:
+                    if options['once']:
+                        return
+                    self.stop.wait(options['poll_interval'])
+                    continue
+
+                job.run()
+                message = f'Image {job.image_id}: {job.status}'
+                if job.status == IngestJob.Status.DONE:
+                    self.stdout.write(self.style.SUCCESS(message))
+                else:
+                    self.stdout.write(self.style.WARNING(f'{message} ({job.error})'))
+        finally:
+            # Each thread has its own database connection
+            connection.close()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from wallpapers import ingest
+from wallpapers.duplicates import duplicate_index
+from wallpapers.models import Image
+from wallpapers.storage import image_storage
+
+HASH_FIELDS = ['image_hash', 'phash', 'dhash', 'whash', 'hash_version']
+
+
+def fingerprint(row):
+    """Hash one stored image, run in a worker process"""
+    pk, name = row
+    try:
+        with image_storage().open(name, 'rb') as f:
+            return pk, ingest.fingerprint(ingest.open_image(f)), None
+    except ValidationError as e:
+        return pk, None, ' '.join(e.messages)
+    except Exception as e:
+        return pk, None, str(e)
+
+
+class Command(BaseCommand):
+    help = (
+        'Computes the perceptual hashes of images that have none or were hashed with an older '
+        'algorithm (ingest.HASH_VERSION). Progress is saved per chunk, so it can be interrupted and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing-only', action='store_true',
+                            help='Only hash images without hashes, leave outdated ones alone')
+        parser.add_argument('--force', action='store_true',
+                            help='Recompute every image, whatever its hash version')
+        parser.add_argument('--start-id', type=int, default=0,
+                            help='Skip images with a lower id, to resume an interrupted --force run')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of hashing processes (default: number of CPUs)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Images hashed and saved per chunk')
+
+    def handle(self, *args, **options):
+        # Queued uploads are hashed by the ingest worker, rejected ones have no file
+        images = Image.objects.filter(status=Image.Status.READY, pk__gte=options['start_id'])
+        if options['missing_only']:
+            images = images.filter(phash__isnull=True)
+        elif not options['force']:
+            images = images.filter(Q(phash__isnull=True) | ~Q(hash_version=ingest.HASH_VERSION))
+        total = images.count()
+        self.stdout.write(f'Hashing {total} images with {options["workers"]} workers...')
+
+        updated = failed = 0
+        last_pk = options['start_id'] - 1
+        # Forked workers must not share the database connection
+        connection.close()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(options['workers'], mp_context=context) as pool:
+            while True:
+                # Walk the table by primary key rather than with one long
+                # running cursor, each chunk is written back before the next
+                # one is read
+                chunk = list(
+                    images.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'image')[:options['chunk_size']]
+                )
+                if not chunk:
+                    break
+
+                to_update = []
+                for pk, hashes, error in pool.map(fingerprint, chunk, chunksize=8):
+                    if error:
+                        failed += 1
+                        self.stderr.write(f'Image {pk}: {error}')
+                        continue
+                    image = Image(pk=pk)
+                    image.set_image_hash(hashes)
+                    to_update.append(image)
+                Image.objects.bulk_update(to_update, HASH_FIELDS)
+
+                updated += len(to_update)
+                last_pk = chunk[-1][0]
+                self.stdout.write(f'  {updated + failed}/{total} done (up to id {last_pk})')
+
+        # Existing hashes changed, which the duplicate index can't notice
+        duplicate_index.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Hashed {updated} images ({failed} failed)'))
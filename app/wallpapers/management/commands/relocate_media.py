@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from wallpapers import caching, ingest
+from wallpapers.models import Image
+from wallpapers.storage import content_name, image_storage, is_content_name
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the files of existing images to their content-addressed names (see wallpapers/storage.py) '
+        'and fills in their SHA-256. Images already moved are skipped, so it can be interrupted and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Images read from the database at once')
+
+    def handle(self, *args, **options):
+        storage = image_storage()
+        images = Image.objects.exclude(image='').order_by('pk')
+        moved = skipped = failed = 0
+        last_pk = 0
+
+        while True:
+            chunk = list(images.filter(pk__gt=last_pk).values_list('pk', 'image', 'content_hash')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+
+            for pk, name, content_hash in chunk:
+                if content_hash and is_content_name(name):
+                    skipped += 1
+                    continue
+                try:
+                    with storage.open(name, 'rb') as f:
+                        content_hash = ingest.content_hash(f)
+                        target = content_name(content_hash, name)
+                        if options['dry_run']:
+                            self.stdout.write(f'Image {pk}: {name} -> {target}')
+                            moved += 1
+                            continue
+                        if target != name:
+                            # Copies of the same bytes end up sharing one file
+                            storage.save(target, f)
+                except OSError as e:
+                    failed += 1
+                    self.stderr.write(f'Image {pk}: {e}')
+                    continue
+
+                # The row points at the new file before the old one goes, an
+                # interruption leaves at worst an orphaned copy
+                Image.objects.filter(pk=pk).update(image=target, content_hash=content_hash)
+                if target != name and not Image.objects.filter(image=name).exists():
+                    storage.delete(name)
+                moved += 1
+
+            self.stdout.write(f'  {moved + skipped + failed} images done (up to id {last_pk})')
+
+        if moved and not options['dry_run']:
+            # Cached pages link to the old file names
+            caching.invalidate()
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Would move" if options["dry_run"] else "Moved"} {moved} images '
+            f'({skipped} already in place, {failed} failed)'
+        ))
@@ -2,14 +2,31 @@ from django.core.management.base import BaseCommand
 from wallpapers.models import ImageOfTheDay
 
 class Command(BaseCommand):
-    help = 'Selects an image of the day if one is not already selected for today'
+    help = 'Selects the image of the day for today and, optionally, plans the following days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1,
+                            help='Number of days to plan, starting today (default: 1)')
+        parser.add_argument('--skip-renditions', action='store_true',
+                            help='Do not generate missing renditions of the planned images')
 
     def handle(self, *args, **options):
+        planned = ImageOfTheDay.plan(options['days'])
+        
+        for image_of_day in planned:
+            # Encode the renditions now rather than when the day comes
+            if not options['skip_renditions'] and not image_of_day.image.renditions:
+                image_of_day.image.generate_renditions()
+            self.stdout.write(f'{image_of_day.date}: image {image_of_day.image.pk}')
+        
+        # Run from cron shortly after midnight so the selection (and the
+        # cache warm-up) happens here rather than on the first request
         image_of_day = ImageOfTheDay.select_image_for_today()
         
         if image_of_day:
             self.stdout.write(self.style.SUCCESS(
-                f'Successfully selected "{image_of_day.image.title}" as the image of the day for {image_of_day.date}'
+                f'Successfully selected image {image_of_day.image.pk} as the image of the day for {image_of_day.date}'
+                f' ({len(planned)} days planned)'
             ))
         else:
             self.stdout.write(self.style.WARNING(
@@ -0,0 +1,163 @@
+"""In-process metrics: counters, histograms and timing spans
+
+Values live in the memory of each process, every gunicorn worker keeps its
+own and a scrape of /metrics only sees the worker that answered it. Labels
+are passed as keyword arguments:
+
+    metrics.increment('captcha_verifications_total', outcome='success')
+    metrics.observe('captcha_verify_seconds', 0.12, outcome='success')
+
+    with metrics.span('download'):
+        ...
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.db import connection
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the histograms of database queries per request
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Prefix of every metric name in the Prometheus exposition
+NAMESPACE = 'wallpapers'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Add value to a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=BUCKETS, **labels):
+    """Record a value (a duration in seconds by default) in a histogram
+
+    The buckets of a histogram are those given the first time it is observed.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'bounds': tuple(buckets), 'buckets': [0] * len(buckets), 'count': 0, 'sum': 0.0,
+            }
+        index = bisect_left(histogram['bounds'], value)
+        if index < len(histogram['bounds']):
+            histogram['buckets'][index] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+@contextmanager
+def span(name):
+    """Time the block in the span_seconds histogram, labelled span=name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('span_seconds', time.perf_counter() - start, span=name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class QueryCounter:
+    """Count the queries run on the default connection
+
+    Unlike CaptureQueriesContext this isn't capped by the 9000 entries of
+    connection.queries_log.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def capture(self):
+        with connection.execute_wrapper(self):
+            yield self
+
+
+def snapshot():
+    """Copy of every metric, as {'counters': {...}, 'histograms': {...}}
+
+    Keys are (name, ((label, value), ...)) tuples, histogram bucket counts
+    are per bucket (not cumulative) and leave out values above the last one.
+    """
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'histograms': {
+                key: {**histogram, 'buckets': list(histogram['buckets'])}
+                for key, histogram in _histograms.items()
+            },
+        }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus():
+    """Every metric in the Prometheus text exposition format (version 0.0.4)"""
+    data = snapshot()
+    lines = []
+
+    typed = set()
+    for (name, labels), value in sorted(data['counters'].items()):
+        name = f'{NAMESPACE}_{name}'
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+    for (name, labels), histogram in sorted(data['histograms'].items()):
+        name = f'{NAMESPACE}_{name}'
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in zip(histogram['bounds'], histogram['buckets']):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {histogram["count"]}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(histogram["sum"])}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,33 @@
+import time
+
+from . import metrics
+
+# Methods are sent by the client, any other is labelled 'other' so that the
+# number of series stays bounded
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+class MetricsMiddleware:
+    """Record the latency and the number of database queries of every request
+
+    Requests are labelled with the name of the view that answered them, so
+    that the number of series stays bounded whatever the URLs requested,
+    and with their method when it is a standard one.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with metrics.QueryCounter().capture() as queries:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        method = request.method if request.method in METHODS else 'other'
+        status = f'{response.status_code // 100}xx'
+        metrics.observe('request_duration_seconds', elapsed, view=view, method=method, status=status)
+        metrics.observe('request_queries', queries.count, buckets=metrics.QUERY_BUCKETS, view=view)
+        return response
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+def to_signed(hex_hash):
+    value = int(hex_hash, 16)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def split_image_hashes(apps, schema_editor):
+    Image = apps.get_model('wallpapers', 'Image')
+    batch = []
+    for image in Image.objects.filter(image_hash__isnull=False).only('image_hash').iterator():
+        try:
+            image.phash, image.dhash, image.whash = (to_signed(h) for h in image.image_hash.split('_'))
+        except ValueError:
+            # Malformed hash, leave it to be recomputed
+            continue
+        batch.append(image)
+        if len(batch) >= 1000:
+            Image.objects.bulk_update(batch, ['phash', 'dhash', 'whash'])
+            batch = []
+    Image.objects.bulk_update(batch, ['phash', 'dhash', 'whash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0003_image_image_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='dhash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='whash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(split_image_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+def mark_existing_hashes(apps, schema_editor):
+    # Hashes stored so far can't be told apart, assume the oldest algorithm
+    # so that `recompute_hashes` brings them up to date
+    Image = apps.get_model('wallpapers', 'Image')
+    Image.objects.filter(phash__isnull=False).update(hash_version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0006_image_status_ingestjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='hash_version',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_existing_hashes, migrations.RunPython.noop),
+    ]
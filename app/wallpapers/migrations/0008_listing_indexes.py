@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0007_image_hash_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(models.OrderBy(models.F('approval_date'), descending=True), models.OrderBy(models.F('id'), descending=True), condition=models.Q(('is_approved', True)), name='image_approved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('is_approved', False), ('status', 'ready')), fields=['upload_date'], name='image_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageoftheday',
+            index=models.Index(fields=['image', 'date'], name='iotd_image_date_idx'),
+        ),
+    ]
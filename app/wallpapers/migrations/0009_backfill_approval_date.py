@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:40
+
+from django.db import migrations
+from django.db.models import F
+
+
+def backfill_approval_date(apps, schema_editor):
+    # Images approved without going through approve() have no approval
+    # date and would be left out of the cursor-paginated gallery
+    Image = apps.get_model('wallpapers', 'Image')
+    Image.objects.filter(is_approved=True, approval_date__isnull=True).update(approval_date=F('upload_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0008_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_approval_date, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:36
+
+import wallpapers.models
+import wallpapers.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0009_backfill_approval_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='image',
+            field=models.ImageField(storage=wallpapers.storage.image_storage, upload_to=wallpapers.models.get_upload_path),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallpapers', '0011_image_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestjob',
+            name='task',
+            field=models.CharField(choices=[('ingest', 'Ingest'), ('renditions', 'Renditions')], default='ingest', max_length=16),
+        ),
+    ]
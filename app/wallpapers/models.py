@@ -1,82 +1,404 @@
+from django.conf import settings
 from django.db import models
+from django.db.models import Count, F, Max, Q
 from django.contrib.auth.models import User
 import os
 from django.utils import timezone
+from django.core.cache import cache
 import datetime
-import imagehash
-from PIL import Image as PILImage
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from django.core.exceptions import ValidationError
+from django.core.files import File
+from . import caching, ingest, metrics, variants
+from .renditions import FORMATS as RENDITION_FORMATS, build_srcset, create_renditions, delete_renditions
+from .duplicates import duplicate_index, hash_to_int
+from .storage import content_name, image_storage
+
+logger = logging.getLogger(__name__)
 
 def get_upload_path(instance, filename):
     """Create a custom upload path for images"""
-    # Just save directly to wallpapers folder with original filename
+    # Files are named after their content, see storage.py
+    if instance.content_hash:
+        return content_name(instance.content_hash, filename)
     return os.path.join('wallpapers', filename)
 
+def duplicate_error(duplicate_image):
+    """ValidationError raised for an upload matching an existing image"""
+    duplicate_info = f" (uploaded on {duplicate_image.upload_date.strftime('%Y-%m-%d')})" if duplicate_image else ""
+    return ValidationError(f"This image appears to be a duplicate or very similar to an existing image{duplicate_info}.")
+
+class ImageQuerySet(models.QuerySet):
+    def approve(self):
+        """Approve all the images of the queryset at once
+        
+        Unlike Image.approve() this is a single UPDATE whatever the number
+        of images. Images that aren't ready for review (still processing,
+        rejected or without a file) are left alone.
+        
+        Encoding the renditions takes far longer than the request may, they
+        are queued for the `ingest_worker` with INGEST_ASYNC. Otherwise only
+        the first APPROVE_INLINE_RENDITIONS images get them straight away,
+        the others are served from their originals until
+        `manage.py generate_renditions` runs.
+        
+        Returns:
+            int: the number of newly approved images
+        """
+        approvable = self.filter(is_approved=False, status=Image.Status.READY).exclude(image='')
+        pks = list(approvable.values_list('pk', flat=True))
+        approved = Image.objects.filter(pk__in=pks).update(is_approved=True, approval_date=timezone.now())
+        pending = Image.objects.filter(pk__in=pks, renditions={}).order_by('pk')
+        if settings.INGEST_ASYNC:
+            IngestJob.queue_renditions(pending.values_list('pk', flat=True))
+        else:
+            pending[:settings.APPROVE_INLINE_RENDITIONS].generate_renditions()
+        # Updates don't send post_save, see signals.py
+        if approved:
+            caching.invalidate()
+        return approved
+    
+    def reject(self):
+        """Reject all the images of the queryset at once, deleting their files
+        
+        Returns:
+            int: the number of newly rejected images
+        """
+        images = list(self.exclude(status=Image.Status.REJECTED).only('pk', 'image', 'content_hash', 'renditions'))
+        pks = [image.pk for image in images]
+        for image in images:
+            image.delete_derived_files(exclude_pks=pks)
+            image.delete_file(exclude_pks=pks)
+        rejected = Image.objects.filter(pk__in=pks).update(
+            status=Image.Status.REJECTED, is_approved=False, approval_date=None, image='',
+            content_hash=None, image_hash=None, phash=None, dhash=None, whash=None, hash_version=None,
+            renditions={}, placeholder=None, dominant_color=None,
+        )
+        ImageOfTheDay.unfeature(pks)
+        if rejected:
+            # The hashes are gone, later uploads must not match them
+            duplicate_index.invalidate()
+            # Rejecting approved images takes them off the public pages
+            caching.invalidate()
+        return rejected
+    
+    def generate_renditions(self, workers=None):
+        """Create the renditions of all the images of the queryset
+        
+        Images are encoded in parallel threads (Pillow releases the GIL
+        while resizing and encoding) and saved with a single bulk_update.
+        Images whose renditions fail are logged and left without.
+        """
+        images = list(self)
+        if not images:
+            return 0
+        
+        def create(image):
+            try:
+                return create_renditions(image)
+            except Exception:
+                logger.exception('Could not create the renditions of image %s', image.pk)
+                return {}, None, None
+        
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            for image, created in zip(images, pool.map(create, images)):
+                image.renditions, image.placeholder, image.dominant_color = created
+        Image.objects.bulk_update(images, ['renditions', 'placeholder', 'dominant_color'])
+        return len(images)
+
 class Image(models.Model):
     """Model for storing uploaded images"""
-    image = models.ImageField(upload_to=get_upload_path)
+    
+    class Status(models.TextChoices):
+        # Stored but not validated/hashed yet, see IngestJob
+        PROCESSING = 'processing', 'Processing'
+        READY = 'ready', 'Ready'
+        REJECTED = 'rejected', 'Rejected'
+    
+    image = models.ImageField(upload_to=get_upload_path, storage=image_storage)
+    # SHA-256 of the file, catches exact copies without decoding them
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)
     source_url = models.URLField(blank=True, null=True)
     upload_date = models.DateTimeField(auto_now_add=True)
     is_approved = models.BooleanField(default=False)
     approval_date = models.DateTimeField(null=True, blank=True)
     image_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    # The same perceptual hashes as 64-bit integers, used for the Hamming
+    # distance of the duplicate check
+    phash = models.BigIntegerField(blank=True, null=True)
+    dhash = models.BigIntegerField(blank=True, null=True)
+    whash = models.BigIntegerField(blank=True, null=True)
+    # ingest.HASH_VERSION the hashes were computed with
+    hash_version = models.PositiveSmallIntegerField(blank=True, null=True)
+    # Downscaled copies for the gallery, see renditions.create_renditions
+    renditions = models.JSONField(default=dict, blank=True)
+    # Micro-thumbnail (data URI) and dominant colour pages paint while the
+    # renditions load, computed with them
+    placeholder = models.TextField(blank=True, null=True)
+    dominant_color = models.CharField(max_length=7, blank=True, null=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.READY)
+    
+    objects = ImageQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            # Home page and API: approved images, newest first
+            models.Index(
+                F('approval_date').desc(), F('id').desc(),
+                condition=Q(is_approved=True), name='image_approved_idx',
+            ),
+            # Review page: pending images, oldest first
+            models.Index(
+                fields=['upload_date'],
+                condition=Q(is_approved=False, status='ready'), name='image_pending_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"Image uploaded on {self.upload_date.strftime('%Y-%m-%d %H:%M')}"
     
+    @property
+    def can_be_approved(self):
+        """Whether the image is ready for review and still has its file"""
+        return self.status == self.Status.READY and bool(self.image)
+    
+    @property
+    def can_be_featured(self):
+        return self.is_approved and self.can_be_approved
+    
     def approve(self):
-        """Approve the image for public display"""
+        """Approve the image for public display
+        
+        Raises:
+            ValidationError: if the image is still processing, was rejected
+                             or has no file
+        """
+        if not self.can_be_approved:
+            raise ValidationError('Only images ready for review can be approved.')
         self.is_approved = True
         self.approval_date = timezone.now()
         self.save()
+        # Like the bulk approval, an image whose renditions fail stays
+        # approved and is served from its original
+        try:
+            self.generate_renditions()
+        except Exception:
+            logger.exception('Could not create the renditions of image %s', self.pk)
+    
+    def generate_renditions(self):
+        """Create (or recreate) the gallery renditions of the image"""
+        self.renditions, self.placeholder, self.dominant_color = create_renditions(self)
+        self.save(update_fields=['renditions', 'placeholder', 'dominant_color'])
+    
+    def rendition_url(self, size):
+        """URL of the JPEG rendition of the given size, or of the original while there is none"""
+        rendition = self.renditions.get(size)
+        if rendition and 'jpeg' in rendition['files']:
+            return self.image.storage.url(rendition['files']['jpeg'])
+        # URL uploads have no file until they are processed
+        return self.image.url if self.image else ''
+    
+    @property
+    def featured_dates(self):
+        """Days the image has been featured, leaving out the planned ones"""
+        return self.featured_days.filter(date__lte=timezone.now().date())
+    
+    @property
+    def thumbnail_url(self):
+        return self.rendition_url('thumbnail')
+    
+    @property
+    def sources(self):
+        """(MIME type, srcset) of each modern format the renditions exist in, best first"""
+        return [
+            (mime_type, build_srcset(self, fmt))
+            for fmt, _, _, mime_type, _ in RENDITION_FORMATS
+            if fmt != 'jpeg' and any(fmt in r['files'] for r in self.renditions.values())
+        ]
+    
+    @property
+    def srcset(self):
+        return build_srcset(self, 'jpeg')
     
-    def calculate_image_hash(self):
-        """Calculate and store the perceptual hash of the image"""
+    @property
+    def display_size(self):
+        """(width, height) of the largest rendition, or None without renditions
+        
+        Given to <img> so that the page keeps room for the image, with its
+        placeholder, before it loads.
+        """
+        if not self.renditions:
+            return None
+        rendition = max(self.renditions.values(), key=lambda rendition: rendition['width'])
+        return rendition['width'], rendition['height']
+    
+    def set_image_hash(self, hashes):
+        """Store a (phash, dhash, whash) fingerprint as computed by ingest.fingerprint"""
+        phash, dhash, whash = hashes
+        self.phash, self.dhash, self.whash = (hash_to_int(h) for h in hashes)
+        self.hash_version = ingest.HASH_VERSION
+        
+        # Combine the hashes to create a more robust fingerprint
+        self.image_hash = f"{phash}_{dhash}_{whash}"
+        return self.image_hash
+    
+    @metrics.timed('calculate_image_hash')
+    def calculate_image_hash(self, img=None):
+        """Calculate and store the perceptual hash of the image
+        
+        Args:
+            img: an already opened PIL image of the file, to avoid opening
+                 it again. When omitted the image is read from the file
+                 field, which works both for a stored file and for an
+                 upload that hasn't been written to storage yet.
+        """
         if not self.image:
             return None
         
-        # Open the image
-        img = PILImage.open(self.image.path)
+        if img is None:
+            img = ingest.open_image(self.image)
         
         # Calculate the perceptual hash - a combination of different hash types
-        # for better accuracy
-        phash = str(imagehash.phash(img))
-        dhash = str(imagehash.dhash(img))
-        whash = str(imagehash.whash(img))
+        # for better accuracy, all computed from a single decode
+        hashes = ingest.fingerprint(img)
         
-        # Combine the hashes to create a more robust fingerprint
-        combined_hash = f"{phash}_{dhash}_{whash}"
-        self.image_hash = combined_hash
-        return combined_hash
+        # Leave the upload ready to be written to storage
+        self.image.seek(0)
+        
+        return self.set_image_hash(hashes)
     
     def save(self, *args, **kwargs):
-        # For new instances, check for duplicates
-        if not self.pk:  # Only check for new images
-            # First, save the image to generate a path
-            super().save(*args, **kwargs)
-            # Calculate the hash
-            self.calculate_image_hash()
+        # The file name is derived from its bytes, they must be hashed
+        # before the file is written, unless the upload form already did. A
+        # new file given to an existing row (e.g. from the admin) is always
+        # hashed again, and needs new perceptual hashes and renditions.
+        replaced_name = None
+        if self.image and not self.image._committed and (self.pk or not self.content_hash):
+            self.content_hash = ingest.content_hash(self.image)
+            if self.pk:
+                replaced_name = Image.objects.filter(pk=self.pk).values_list('image', flat=True).first()
+                self.calculate_image_hash()
+                self.renditions, self.placeholder, self.dominant_color = {}, None, None
+        
+        # For new instances, check for duplicates before anything is written:
+        # the upload is hashed from memory (or its temporary file) so a
+        # duplicate never reaches the media folder or the database.
+        # Uploads queued for processing are checked by ingest() instead.
+        if not self.pk and self.status == self.Status.READY:
+            if self.phash is None:
+                self.calculate_image_hash()
             
-            # Check for duplicates
             is_duplicate, duplicate_image = self.check_for_duplicates()
             
             if is_duplicate:
-                # If duplicate is found, delete the image file to prevent orphaned files
-                if self.image and hasattr(self.image, 'path') and os.path.exists(self.image.path):
-                    os.remove(self.image.path)
-                
-                # Delete this object from the database to prevent creating a duplicate entry
-                self.delete()
-                
                 # Raise a validation error with details about the duplicate
-                duplicate_info = f" (uploaded on {duplicate_image.upload_date.strftime('%Y-%m-%d')})" if duplicate_image else ""
-                raise ValidationError(f"This image appears to be a duplicate or very similar to an existing image{duplicate_info}.")
+                raise duplicate_error(duplicate_image)
+        
+        # The gallery is paginated on approval_date, approving by ticking
+        # is_approved in the admin must set it too
+        if self.is_approved and self.approval_date is None:
+            self.approval_date = timezone.now()
+        
+        super().save(*args, **kwargs)
+        
+        if replaced_name is not None:
+            self._file_replaced(replaced_name)
+    
+    def _file_replaced(self, old_name):
+        """Bring derived data in line with the new file of an existing row"""
+        # The duplicate index only notices new and deleted rows by itself
+        duplicate_index.invalidate()
+        if old_name and old_name != self.image.name and not Image.objects.filter(image=old_name).exists():
+            self.image.storage.delete(old_name)
+        if self.is_approved:
+            try:
+                self.generate_renditions()
+            except Exception:
+                logger.exception('Could not create the renditions of image %s', self.pk)
+    
+    def ingest(self):
+        """Validate, hash and deduplicate an upload queued for processing
+        
+        URL uploads are downloaded first. The image is marked ready for
+        review, or rejected (and its file removed) when it fails validation
+        or is a duplicate.
+        
+        Raises:
+            ValidationError: if the image was rejected
+        """
+        content = None
+        try:
+            if self.image:
+                hashes = ingest.prepare(self.image)
+                self.image.close()
+            else:
+                content = ingest.download(self.source_url)
+                self.content_hash = ingest.content_hash(content)
+                hashes = ingest.prepare(content)
+            self.set_image_hash(hashes)
             
-            # Save again with the hash (only if not a duplicate)
-            super().save(*args, **kwargs)
+            is_duplicate, duplicate_image = self.check_for_duplicates()
+            if is_duplicate:
+                raise duplicate_error(duplicate_image)
+            
+            if content is not None:
+                self.image.save(ingest.filename_from_url(self.source_url), File(content), save=False)
+        except ValidationError:
+            self.reject()
+            raise
+        finally:
+            if content is not None:
+                content.close()
+        
+        self.status = self.Status.READY
+        self.save()
+    
+    def delete_file(self, exclude_pks=()):
+        """Delete the file of the image, unless another image has the same one
+        
+        Identical files share their content-addressed name, which happens
+        with copies uploaded before duplicates were detected.
+        """
+        if not self.image:
+            return
+        others = Image.objects.filter(image=self.image.name).exclude(pk=self.pk).exclude(pk__in=exclude_pks)
+        if others.exists():
+            self.image.name = None
         else:
-            super().save(*args, **kwargs)
+            self.image.delete(save=False)
+    
+    def delete_derived_files(self, exclude_pks=()):
+        """Delete the renditions and the image of the day variants of the image
+        
+        The variants are shared by the images with the same content_hash,
+        they are kept while another one still exists.
+        """
+        delete_renditions(self)
+        shared = self.content_hash and Image.objects.filter(content_hash=self.content_hash).exclude(
+            pk=self.pk).exclude(pk__in=exclude_pks).exists()
+        if not shared:
+            variants.variant_cache().purge(variants.variant_prefix(self))
+    
+    def reject(self):
+        """Mark the image as rejected and free its file and the files made from it"""
+        # Renditions and variants are served from /media/ as well, they
+        # must go with the original
+        self.delete_derived_files()
+        self.delete_file()
+        self.renditions, self.placeholder, self.dominant_color = {}, None, None
+        # A rejected image must not match later uploads as a duplicate
+        self.content_hash = self.image_hash = self.phash = self.dhash = self.whash = self.hash_version = None
+        self.status = self.Status.REJECTED
+        self.save()
+        duplicate_index.invalidate()
+        ImageOfTheDay.unfeature([self.pk])
+    
+    def find_exact_duplicate(self):
+        """Return an existing image with the very same bytes, or None"""
+        return Image.objects.filter(content_hash=self.content_hash).exclude(pk=self.pk).order_by('pk').first()
     
+    @metrics.timed('check_for_duplicates')
     def check_for_duplicates(self):
         """Check if an image with the same hash already exists
         
@@ -85,49 +407,21 @@ class Image(models.Model):
                   is_duplicate is True if a duplicate was found, False otherwise
                   duplicate_image is the first duplicate Image object if found, None otherwise
         """
-        if not self.image_hash:
-            self.calculate_image_hash()
-        
-        # Split the combined hash back into components
-        phash, dhash, whash = self.image_hash.split('_')
-        
-        # Check for exact hash matches
-        duplicates = Image.objects.filter(image_hash=self.image_hash).exclude(pk=self.pk)
+        # Byte for byte copies are found by their SHA-256 alone, without
+        # decoding the image
+        if self.content_hash:
+            duplicate_image = self.find_exact_duplicate()
+            if duplicate_image is not None:
+                return True, duplicate_image
         
-        if duplicates.exists():
-            # Return True and the first duplicate image
-            return True, duplicates.first()
-        
-        # Check for similar hashes (partial matches)
-        # We'll query each hash component separately and then check the similarity
-        similar_images = []
+        if self.phash is None:
+            self.calculate_image_hash()
         
-        for img in Image.objects.exclude(pk=self.pk):
-            if not img.image_hash:
-                continue
-                
-            img_phash, img_dhash, img_whash = img.image_hash.split('_')
-            
-            # Calculate Hamming distance (number of differing bits)
-            # Lower distance means more similar images
-            phash_distance = sum(c1 != c2 for c1, c2 in zip(phash, img_phash))
-            dhash_distance = sum(c1 != c2 for c1, c2 in zip(dhash, img_dhash))
-            whash_distance = sum(c1 != c2 for c1, c2 in zip(whash, img_whash))
-            
-            # Calculate an average similarity score (lower is more similar)
-            avg_distance = (phash_distance + dhash_distance + whash_distance) / 3
-            
-            # If the average distance is below a threshold, consider it a duplicate
-            # Threshold of 5 is relatively strict but allows for minor variations
-            if avg_distance < 5:
-                similar_images.append(img)
-        
-        if similar_images:
-            # Return True and the first similar image
-            return True, similar_images[0]
-            
-        # No duplicates found
-        return False, None
+        # Exact matches and near-duplicates are both answered by a single
+        # vectorized Hamming distance over the hashes of every image
+        with metrics.span('duplicate_scan'):
+            duplicate_image = duplicate_index.find((self.phash, self.dhash, self.whash), exclude_pk=self.pk)
+        return duplicate_image is not None, duplicate_image
 
 class ImageOfTheDay(models.Model):
     """Model for tracking which image is selected for each day"""
@@ -136,61 +430,251 @@ class ImageOfTheDay(models.Model):
     
     class Meta:
         ordering = ['-date']
+        indexes = [
+            # Covers the per-image count and last date of the selection
+            models.Index(fields=['image', 'date'], name='iotd_image_date_idx'),
+        ]
     
     def __str__(self):
         return f"Image of the day - {self.date}"
     
+    @staticmethod
+    def cache_key(date):
+        # Holds the primary key of the day, the former key held a pickled row
+        return f'wallpapers:image-of-the-day-pk:{date.isoformat()}'
+    
+    @classmethod
+    def clear_cache(cls, date=None):
+        """Forget the cached selection of a day (today by default)"""
+        cache.delete(cls.cache_key(date or timezone.now().date()))
+    
     @classmethod
+    def unfeature(cls, image_pks):
+        """Take images off today and the planned days, which get reselected
+        
+        Past days are kept, they are the history of the images.
+        """
+        today = timezone.now().date()
+        cls.objects.filter(image_id__in=image_pks, date__gte=today).delete()
+        cls.clear_cache(today)
+    
+    @classmethod
+    @metrics.timed('select_image_for_today')
     def select_image_for_today(cls):
         """
-        Select a random image for today that:
+        Return today's image of the day, selecting it if needed.
+        
+        The primary key of the selection is cached until midnight so the hot
+        endpoints only do a cache lookup and a primary key fetch, which
+        always sees the current renditions, placeholder and admin edits. The
+        `select_image_of_the_day` command runs the selection ahead of the
+        first request of the day.
+        """
+        now = timezone.now()
+        today = now.date()
+        key = cls.cache_key(today)
+        
+        pk = cache.get(key)
+        if pk is not None:
+            image_of_day = cls.objects.select_related('image').filter(pk=pk, date=today).first()
+            if image_of_day and image_of_day.image.can_be_featured:
+                return image_of_day
+        
+        image_of_day = cls.select_image_for_date(today)
+        if image_of_day:
+            tomorrow = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min, tzinfo=now.tzinfo)
+            cache.set(key, image_of_day.pk, (tomorrow - now).total_seconds())
+        return image_of_day
+    
+    @classmethod
+    def plan(cls, days, start=None):
+        """
+        Select the images of the next `days` days, starting today.
+        
+        Days already planned are kept. Each planned day counts as a feature
+        for the following ones, so the rotation follows the same policy as
+        day-by-day selection.
+        
+        Returns:
+            list: the ImageOfTheDay of each planned day, shorter than `days`
+                  if there are no approved images to pick from
+        """
+        start = start or timezone.now().date()
+        planned = []
+        for offset in range(days):
+            image_of_day = cls.select_image_for_date(start + datetime.timedelta(days=offset))
+            if image_of_day is None:
+                break
+            planned.append(image_of_day)
+        return planned
+    
+    @classmethod
+    def select_image_for_date(cls, date):
+        """
+        Select a random image for the given day that:
         1. Is approved
-        2. Was not the image of yesterday
+        2. Was not the image of the day before
         3. Prioritizes images that haven't been featured yet or were featured long ago
-        """
-        today = timezone.now().date()
         
-        # Check if we already have an image for today
-        existing = cls.objects.filter(date=today).first()
-        if existing:
+        A day already selected keeps its image, unless that image can't be
+        shown anymore (unapproved, rejected, file gone): it is replaced.
+        """
+        # Check if we already have an image for that day
+        existing = cls.objects.select_related('image').filter(date=date).first()
+        if existing and existing.image.can_be_featured:
             return existing
         
         # Get yesterday's image to avoid selecting it again
-        yesterday = today - datetime.timedelta(days=1)
-        yesterday_image_id = None
-        yesterday_image = cls.objects.filter(date=yesterday).first()
-        if yesterday_image:
-            yesterday_image_id = yesterday_image.image.id
+        yesterday = date - datetime.timedelta(days=1)
+        yesterday_image_id = cls.objects.filter(date=yesterday).values_list('image_id', flat=True).first()
         
         # Get all approved images except yesterday's
-        approved_images = Image.objects.filter(is_approved=True)
+        approved_images = Image.objects.filter(is_approved=True, status=Image.Status.READY).exclude(image='')
         if yesterday_image_id:
             approved_images = approved_images.exclude(id=yesterday_image_id)
+        if existing:
+            approved_images = approved_images.exclude(id=existing.image_id)
         
-        if not approved_images.exists():
+        # Pick, in a single query, among the images featured the least number
+        # of times (never featured ones first), the one featured the longest
+        # time ago, ties being broken randomly by the database
+        selected_image = approved_images.annotate(
+            times_featured=Count('featured_days'),
+            last_featured=Max('featured_days__date'),
+        ).order_by('times_featured', F('last_featured').asc(nulls_first=True), '?').first()
+        
+        if existing:
+            return cls._replace(existing, selected_image)
+        
+        if selected_image is None:
             return None
         
-        # Find images that have never been featured
-        never_featured = approved_images.exclude(
-            id__in=cls.objects.values_list('image__id', flat=True)
+        # Create the image of the day record. If another worker selected
+        # an image for the same day in the meantime, theirs is kept.
+        image_of_day, _ = cls.objects.select_related('image').get_or_create(
+            date=date, defaults={'image': selected_image}
         )
+        return image_of_day
+    
+    @classmethod
+    def _replace(cls, existing, image):
+        """Feature image instead of the unshowable one of an existing day
         
-        if never_featured.exists():
-            # Select a random image from never featured
-            from random import choice
-            selected_image = choice(list(never_featured))
+        The day is deleted when there is no image to replace it with. When
+        another worker replaced it first, theirs is kept.
+        """
+        rows = cls.objects.filter(pk=existing.pk, image_id=existing.image_id)
+        if image is None:
+            rows.delete()
         else:
-            # Select the image that was featured longest time ago
-            # or the least number of times
-            featured_counts = {}
-            for img in approved_images:
-                featured_counts[img.id] = cls.objects.filter(image=img).count()
-            
-            min_count = min(featured_counts.values())
-            least_featured = [img_id for img_id, count in featured_counts.items() if count == min_count]
-            
-            from random import choice
-            selected_image = Image.objects.get(id=choice(least_featured))
+            rows.update(image=image)
+        # update() sends no post_save, see signals.py
+        cls.clear_cache(existing.date)
+        caching.invalidate()
+        return cls.objects.select_related('image').filter(date=existing.date).first()
+
+class IngestJob(models.Model):
+    """Queued processing of an upload, run by the `ingest_worker` command
+    
+    The same queue creates the renditions of images approved in bulk, the
+    job of an image being reused for it once the upload is processed.
+    """
+    
+    class Task(models.TextChoices):
+        INGEST = 'ingest', 'Ingest'
+        RENDITIONS = 'renditions', 'Renditions'
+    
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+    
+    # Jobs failing with an unexpected error are retried this many times
+    MAX_ATTEMPTS = 3
+    
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, related_name='ingest_job')
+    task = models.CharField(max_length=16, choices=Task.choices, default=Task.INGEST)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"Ingest job {self.pk} ({self.status})"
+    
+    @classmethod
+    def claim(cls):
+        """Take the oldest queued job, or return None if the queue is empty
         
-        # Create the image of the day record
-        return cls.objects.create(image=selected_image, date=today)
+        The job is claimed with a conditional UPDATE so that concurrent
+        workers, in this process or another, never run the same job.
+        """
+        candidates = cls.objects.filter(status=cls.Status.QUEUED).values_list('pk', flat=True)[:10]
+        for pk in candidates:
+            claimed = cls.objects.filter(pk=pk, status=cls.Status.QUEUED).update(
+                status=cls.Status.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+            )
+            if claimed:
+                return cls.objects.select_related('image').get(pk=pk)
+        return None
+    
+    @classmethod
+    def queue_renditions(cls, image_pks):
+        """Queue the creation of the renditions of images
+        
+        Returns:
+            int: the number of queued jobs
+        """
+        image_pks = list(image_pks)
+        fields = {
+            'task': cls.Task.RENDITIONS, 'status': cls.Status.QUEUED, 'attempts': 0, 'error': '',
+            'started_at': None, 'finished_at': None,
+        }
+        existing = set(cls.objects.filter(image_id__in=image_pks).values_list('image_id', flat=True))
+        cls.objects.filter(image_id__in=existing).update(created_at=timezone.now(), **fields)
+        cls.objects.bulk_create([cls(image_id=pk, **fields) for pk in image_pks if pk not in existing])
+        return len(image_pks)
+    
+    @classmethod
+    def requeue_stale(cls, timeout):
+        """Put back in the queue jobs left running by a worker that died"""
+        return cls.objects.filter(
+            status=cls.Status.RUNNING, started_at__lt=timezone.now() - timeout
+        ).update(status=cls.Status.QUEUED)
+    
+    def run(self):
+        """Process the image, recording the outcome on the job"""
+        try:
+            if self.task == self.Task.RENDITIONS:
+                # Images rejected since they were queued are skipped
+                if self.image.can_be_featured:
+                    self.image.generate_renditions()
+            else:
+                self.image.ingest()
+        except ValidationError as e:
+            self.status = self.Status.FAILED
+            self.error = ' '.join(e.messages)
+        except Exception as e:
+            self.error = str(e)
+            if self.attempts < self.MAX_ATTEMPTS:
+                self.status = self.Status.QUEUED
+            else:
+                self.status = self.Status.FAILED
+                # An approved image without renditions is still served
+                # from its original
+                if self.task == self.Task.INGEST:
+                    self.image.reject()
+        else:
+            self.status = self.Status.DONE
+            self.error = ''
+        self.finished_at = timezone.now()
+        self.save()
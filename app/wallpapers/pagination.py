@@ -0,0 +1,116 @@
+"""Keyset (cursor) pagination over approved images
+
+OFFSET paging gets slower with every page as the database still walks all
+the skipped rows, and needs a COUNT(*) per request. Here pages are instead
+delimited by the (approval_date, id) of the image they start after, an
+opaque cursor that maps to a range scan of image_approved_idx.
+"""
+import base64
+import datetime
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(image):
+    """Opaque cursor pointing at an image's position in the gallery"""
+    value = f'{image.approval_date.isoformat()}|{image.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(approval_date, pk) of a cursor, raises ValueError when it is invalid"""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        approval_date, pk = value.split('|')
+        approval_date, pk = parse_datetime(approval_date), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+    if approval_date is None:
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return approval_date, pk
+
+
+def parse_since(value):
+    """(approval_date, pk) to sync from, given a cursor or an ISO 8601 datetime"""
+    approval_date = parse_datetime(value)
+    if approval_date is None:
+        return decode_cursor(value)
+    if approval_date.tzinfo is None:
+        approval_date = approval_date.replace(tzinfo=datetime.timezone.utc)
+    # Everything approved at that very instant or later
+    return approval_date, 0
+
+
+def after(position):
+    """Filter for the images older than position in the gallery order"""
+    approval_date, pk = position
+    return Q(approval_date__lt=approval_date) | Q(approval_date=approval_date, pk__lt=pk)
+
+
+def before(position):
+    """Filter for the images newer than position in the gallery order"""
+    approval_date, pk = position
+    return Q(approval_date__gt=approval_date) | Q(approval_date=approval_date, pk__gt=pk)
+
+
+class CursorPage:
+    """A page of images along with the cursors of its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def paginate(queryset, per_page, after_cursor=None, before_cursor=None):
+    """Return the CursorPage of queryset, newest first, starting after or ending before a cursor
+
+    Args:
+        queryset: approved images, any ordering is replaced
+        after_cursor: return the page following that cursor
+        before_cursor: return the page preceding that cursor
+
+    Raises:
+        ValueError: when a cursor is invalid
+    """
+    queryset = queryset.filter(approval_date__isnull=False)
+    if before_cursor:
+        # Walk backwards from the cursor, one extra row tells whether there
+        # is yet another page before this one
+        rows = list(queryset.filter(before(decode_cursor(before_cursor))).order_by('approval_date', 'pk')[:per_page + 1])
+        if not rows:
+            # Nothing newer any more, start over from the newest images
+            return paginate(queryset, per_page)
+        has_previous = len(rows) > per_page
+        images = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if after_cursor:
+            queryset = queryset.filter(after(decode_cursor(after_cursor)))
+        rows = list(queryset.order_by('-approval_date', '-pk')[:per_page + 1])
+        has_next = len(rows) > per_page
+        images = rows[:per_page]
+        has_previous = after_cursor is not None
+
+    if not images:
+        return CursorPage([])
+    return CursorPage(
+        images,
+        next_cursor=encode_cursor(images[-1]) if has_next else None,
+        previous_cursor=encode_cursor(images[0]) if has_previous else None,
+    )
@@ -0,0 +1,149 @@
+"""Resized copies of the wallpapers for the gallery
+
+Originals are at least 1920x1080 and often 4K, far more than a gallery card
+needs. Every image gets a few downscaled renditions, each encoded as JPEG,
+WebP and, when Pillow has an AVIF encoder, AVIF. Templates serve them with
+srcset so browsers pick the smallest file that fits.
+
+Every image also gets a placeholder, a micro-thumbnail small enough to be
+inlined as a data URI, and its dominant colour: pages paint them while the
+renditions load, without any extra request.
+"""
+import base64
+from io import BytesIO
+
+from PIL import Image as PILImage
+from PIL import ImageOps
+from django.core.files.base import ContentFile
+
+try:
+    # Pillow < 11 only encodes AVIF through this optional plugin
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Name and width of each rendition, the height follows the aspect ratio
+SIZES = {
+    'thumbnail': 480,
+    'medium': 960,
+    'large': 1920,
+}
+
+# Width of the placeholder, about 150 bytes as WebP once base64 encoded
+PLACEHOLDER_WIDTH = 32
+
+# Format name, PIL format, file extension, MIME type and encoder options
+FORMATS = [
+    ('avif', 'AVIF', 'avif', 'image/avif', {'quality': 60}),
+    ('webp', 'WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', 'jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+]
+
+
+def available_formats():
+    """Formats the installed Pillow can encode"""
+    # Opening a JPEG only loads the core plugins, load the WebP/AVIF ones too
+    PILImage.init()
+    return [fmt for fmt in FORMATS if fmt[1] in PILImage.SAVE]
+
+
+def rendition_name(image, size, extension):
+    return f'renditions/{image.pk}/{size}.{extension}'
+
+
+def delete_renditions(image):
+    """Delete the rendition files of an Image from its storage
+
+    Files left over by an interrupted generation, which Image.renditions
+    doesn't list, are deleted too.
+    """
+    storage = image.image.storage
+    names = {rendition_name(image, size, fmt[2]) for size in SIZES for fmt in FORMATS}
+    names.update(name for rendition in image.renditions.values() for name in rendition['files'].values())
+    for name in names:
+        storage.delete(name)
+
+
+def compute_placeholder(img):
+    """(data URI, '#rrggbb' dominant colour) of the placeholder of an RGB PIL image"""
+    small = img.copy()
+    small.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH))
+    buffer = BytesIO()
+    if 'WEBP' in PILImage.SAVE:
+        small.save(buffer, 'WEBP', quality=40)
+        mime_type = 'image/webp'
+    else:
+        small.save(buffer, 'JPEG', quality=40)
+        mime_type = 'image/jpeg'
+    data_uri = f'data:{mime_type};base64,{base64.b64encode(buffer.getvalue()).decode()}'
+
+    # The most common of a few representative colours, unlike the average
+    # it is a colour that is actually in the image
+    quantized = small.quantize(colors=8)
+    _, index = max(quantized.getcolors())
+    red, green, blue = quantized.getpalette()[index * 3:index * 3 + 3]
+    return data_uri, f'#{red:02x}{green:02x}{blue:02x}'
+
+
+def create_placeholder(image):
+    """Placeholder of an Image as computed by compute_placeholder, from its
+    smallest JPEG rendition when it has one, else from its original
+    """
+    jpegs = sorted(
+        (rendition['width'], rendition['files']['jpeg'])
+        for rendition in image.renditions.values()
+        if 'jpeg' in rendition['files']
+    )
+    with image.image.storage.open(jpegs[0][1] if jpegs else image.image.name, 'rb') as f:
+        img = PILImage.open(f)
+        img.draft('RGB', (SIZES['thumbnail'], SIZES['thumbnail'] * img.height // img.width))
+        return compute_placeholder(ImageOps.exif_transpose(img).convert('RGB'))
+
+
+def create_renditions(image):
+    """Encode every rendition of an Image and write them to its storage
+
+    Returns:
+        tuple: (renditions, placeholder, dominant colour), renditions being
+               rendition name -> {'width', 'height', 'files': {format: storage name}}
+               as stored in Image.renditions
+    """
+    storage = image.image.storage
+    largest = max(SIZES.values())
+
+    with image.image.open('rb') as f:
+        img = PILImage.open(f)
+        # JPEGs can be decoded at a reduced scale, no need for every 4K pixel
+        img.draft('RGB', (largest, largest * img.height // img.width))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+    renditions = {}
+    for size, width in sorted(SIZES.items(), key=lambda item: item[1], reverse=True):
+        width = min(width, img.width)
+        height = round(img.height * width / img.width)
+        resized = img.resize((width, height), PILImage.LANCZOS)
+        # Downscale the next (smaller) rendition from this one, it's cheaper
+        img = resized
+
+        files = {}
+        for fmt, pil_format, extension, _, options in available_formats():
+            buffer = BytesIO()
+            resized.save(buffer, pil_format, **options)
+            name = rendition_name(image, size, extension)
+            if storage.exists(name):
+                storage.delete(name)
+            files[fmt] = storage.save(name, ContentFile(buffer.getvalue()))
+        renditions[size] = {'width': width, 'height': height, 'files': files}
+    # The smallest rendition is still plenty for the placeholder
+    return (renditions, *compute_placeholder(img))
+
+
+def build_srcset(image, fmt):
+    """srcset attribute value listing every rendition of an Image in fmt"""
+    storage = image.image.storage
+    candidates = sorted(
+        (rendition['width'], rendition['files'][fmt])
+        for rendition in image.renditions.values()
+        if fmt in rendition['files']
+    )
+    return ', '.join(f'{storage.url(name)} {width}w' for width, name in candidates)
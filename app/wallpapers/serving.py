@@ -0,0 +1,107 @@
+"""Streaming of files from MEDIA_ROOT with conditional and range requests
+
+Files are never read into memory: they are either handed to the WSGI
+server's file wrapper (sendfile where available) or, when
+settings.SENDFILE_BACKEND is set, to the front web server through an
+X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd) header.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def _parse_range(header, size):
+    """Return the (start, end) byte positions (inclusive) of a single-range
+    Range header, None to serve the whole file, or False when unsatisfiable
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Malformed or multiple ranges, which we don't support: serve it all
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range, the last N bytes
+        length = int(end)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _offload(path):
+    """Response asking the front web server to send the file, or None"""
+    backend = settings.SENDFILE_BACKEND
+    if backend == 'x-accel-redirect':
+        response = HttpResponse()
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        response['X-Accel-Redirect'] = settings.SENDFILE_URL_PREFIX.rstrip('/') + '/' + relative.replace(os.sep, '/')
+        return response
+    if backend == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = path
+        return response
+    return None
+
+
+def serve_file(request, path, content_type, etag=None, last_modified=None):
+    """Serve a file with ETag/Last-Modified validation and Range support
+
+    Args:
+        path: absolute path of the file, inside MEDIA_ROOT for X-Accel-Redirect
+        etag: unquoted entity tag identifying the file content
+        last_modified: datetime of the last change, defaults to the file mtime
+    """
+    stat = os.stat(path)
+    last_modified = int(last_modified.timestamp()) if last_modified else int(stat.st_mtime)
+    etag = quote_etag(etag) if etag else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _offload(path)
+    if response is None:
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if 'Range' in request.headers and (not if_range or if_range == etag):
+            byte_range = _parse_range(request.headers['Range'], stat.st_size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(_read_range(path, start, end - start + 1), status=206)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(path, 'rb'))
+        response['Accept-Ranges'] = 'bytes'
+
+    response['Content-Type'] = content_type
+    if etag:
+        response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
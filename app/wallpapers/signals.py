@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import caching
+from .models import Image, ImageOfTheDay
+
+
+@receiver(post_save, sender=ImageOfTheDay)
+@receiver(post_delete, sender=ImageOfTheDay)
+def clear_image_of_the_day_cache(sender, instance, **kwargs):
+    """Drop the cached selection when a day's image is changed or deleted
+
+    post_delete is also sent for rows removed by a cascade, e.g. when the
+    featured Image itself is deleted.
+    """
+    ImageOfTheDay.clear_cache(instance.date)
+    caching.invalidate()
+
+
+@receiver(post_save, sender=Image)
+def invalidate_pages_on_image_change(sender, instance, **kwargs):
+    """Drop the cached pages when a public image changes
+
+    New uploads and images never approved don't show on any cached page.
+    Unapproving keeps the approval date, so it still invalidates.
+    """
+    if instance.approval_date is not None:
+        caching.invalidate()
+
+
+@receiver(post_delete, sender=Image)
+def invalidate_pages_on_image_delete(sender, instance, **kwargs):
+    if instance.approval_date is not None:
+        caching.invalidate()
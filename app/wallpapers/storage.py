@@ -0,0 +1,54 @@
+"""Storage of the original wallpapers under names derived from their bytes
+
+An upload is stored as wallpapers/ab/cd/abcd...ef.jpg, the SHA-256 of its
+content split into two levels of subdirectories so that no directory holds
+more than a few files even with millions of images. The same bytes always
+get the same name: no more random suffixes on filename collisions, and a
+file that is already there is never written a second time.
+"""
+import os
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+
+_CONTENT_NAME = re.compile(r'^wallpapers/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(\.\w+)?$')
+
+
+def content_name(digest, filename):
+    """Storage name of a file given its SHA-256 and its original filename"""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'wallpapers/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def is_content_name(name):
+    return bool(_CONTENT_NAME.match(name))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage saving content-addressed names at most once
+
+    A content-addressed name that already exists holds the very same bytes,
+    saving it again keeps the existing file rather than writing a copy
+    under another name. Other names are handled as usual.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if is_content_name(name):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if not is_content_name(name):
+            return super()._save(name, content)
+        if self.exists(name):
+            return name
+        # Written aside then renamed, so that a concurrent upload of the same
+        # bytes never sees a partial file and both simply end up with it
+        temporary = super()._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
+
+
+def image_storage():
+    return ContentAddressedStorage()
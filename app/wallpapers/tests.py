@@ -1,3 +1,749 @@
-from django.test import TestCase
+import datetime
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from .benchmarks import create_catalogue, listing_queries, synthetic_wallpaper
+from . import benchmarks, caching, ingest, metrics
+from .duplicates import DuplicateIndex
+from .models import Image, ImageOfTheDay, IngestJob
+from .pagination import decode_cursor, encode_cursor, paginate, parse_since
+from .serving import _parse_range
+from .utils import CircuitBreaker, verify_captcha
+from .variants import InvalidVariant, parse_request
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
+
+class MediaTestCase(TestCase):
+    """TestCase with a throwaway MEDIA_ROOT and cache"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root, CACHES=LOCMEM_CACHES))
+        cache.clear()
+
+    def create_images(self, count, approved=True, **kwargs):
+        """Images with a small but real file each"""
+        images = create_catalogue(count, approved=approved, **kwargs)
+        for i, image in enumerate(images):
+            image.image.storage.save(image.image.name, BytesIO(synthetic_wallpaper((64, 36), seed=i)))
+        return images
+
+
+class QueryPlanTests(TestCase):
+    """The listing queries use the indexes made for them"""
+
+    def setUp(self):
+        create_catalogue(200, featured=100)
+        create_catalogue(50, approved=False)
+        # Planners only pick an index over a scan with up to date statistics
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertPlansUseIndexes(self):
+        for case, index, queryset in listing_queries():
+            with self.subTest(case):
+                self.assertIn(index, queryset.explain())
+
+    def test_sqlite_plans(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        self.assertPlansUseIndexes()
+
+    def test_postgresql_plans(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('PostgreSQL only')
+        # A table this small is cheaper to scan, rule that out to check that
+        # the indexes can serve the queries
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            self.assertPlansUseIndexes()
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = on')
+
+
+class UploadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch('wallpapers.forms.verify_captcha', return_value=True))
+
+    def upload(self, content, name='wallpaper.jpg'):
+        return self.client.post('/upload/', {
+            'captcha_token': 'token', 'image': SimpleUploadedFile(name, content, 'image/jpeg'),
+        })
+
+    def stored_files(self):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(settings.MEDIA_ROOT) for name in names)
+
+    def test_duplicates_write_no_file_and_no_row(self):
+        original = synthetic_wallpaper((1920, 1080))
+        self.assertEqual(self.upload(original).status_code, 302)
+        files = self.stored_files()
+        self.assertEqual(len(files), 1)
+
+        # The same bytes, then the same picture encoded differently
+        for content in (original, synthetic_wallpaper((1920, 1080), format='PNG')):
+            with self.subTest(len(content)):
+                response = self.upload(content, 'copy.png')
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, 'duplicate')
+                self.assertEqual(Image.objects.count(), 1)
+                self.assertEqual(self.stored_files(), files)
+
+
+class CursorTests(TestCase):
+    def test_round_trip(self):
+        image = Image(pk=42, approval_date=datetime.datetime(2025, 1, 2, 3, 4, 5, 678, tzinfo=datetime.timezone.utc))
+        self.assertEqual(decode_cursor(encode_cursor(image)), (image.approval_date, 42))
+
+    def test_invalid_cursors(self):
+        for cursor in ('', 'garbage', '!!!', 'bm90LWEtZGF0ZXwx'):
+            with self.subTest(cursor=cursor), self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_since_accepts_datetimes(self):
+        self.assertEqual(
+            parse_since('2025-01-02T03:04:05'),
+            (datetime.datetime(2025, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc), 0),
+        )
+
+    def test_pages_cover_every_image_once(self):
+        images = create_catalogue(25)
+        queryset = Image.objects.filter(is_approved=True).order_by('-approval_date', '-id')
+        seen, cursor = [], None
+        while True:
+            page = paginate(queryset, 10, after_cursor=cursor)
+            seen.extend(image.pk for image in page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, [image.pk for image in images])
+
+        # and back from the last page
+        page = paginate(queryset, 10, before_cursor=encode_cursor(images[-5]))
+        self.assertEqual([image.pk for image in page], [image.pk for image in images[10:20]])
+
+
+class ImagesApiTests(TestCase):
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_follows_next_pages(self):
+        images = create_catalogue(7)
+        create_catalogue(2, approved=False)
+        seen, url = [], '/api/images/?limit=3'
+        while url:
+            page = self.get(url)
+            seen.extend(result['id'] for result in page['results'])
+            url = page['next']
+        self.assertEqual(seen, [image.pk for image in images])
+
+    def test_syncs_from_since(self):
+        images = create_catalogue(5)
+        page = self.get('/api/images/?since=2000-01-01T00:00:00&limit=3')
+        self.assertEqual([result['id'] for result in page['results']], [image.pk for image in images[:1:-1]])
+
+        page = self.get(page['next'])
+        self.assertEqual([result['id'] for result in page['results']], [images[1].pk, images[0].pk])
+        self.assertIsNone(page['next'])
+        # Nothing new yet, the client keeps its position
+        since = page['since']
+        self.assertEqual(self.get(f'/api/images/?since={since}'), {'results': [], 'next': None, 'since': since})
+
+        newer = create_catalogue(1)[0]
+        Image.objects.filter(pk=newer.pk).update(approval_date=timezone.now() + datetime.timedelta(minutes=1))
+        self.assertEqual([result['id'] for result in self.get(f'/api/images/?since={since}')['results']], [newer.pk])
+
+    def test_invalid_parameters(self):
+        for query in ('after=garbage', 'since=garbage', 'limit=many'):
+            with self.subTest(query):
+                self.assertEqual(self.client.get(f'/api/images/?{query}').status_code, 400)
+
+
+class RangeTests(TestCase):
+    def test_parse_range(self):
+        cases = [
+            ('bytes=0-99', (0, 99)),
+            ('bytes=100-', (100, 999)),
+            ('bytes=-100', (900, 999)),
+            ('bytes=900-5000', (900, 999)),
+            ('bytes=1000-', False),
+            ('bytes=50-10', False),
+            ('bytes=-0', False),
+            ('bytes=-', None),
+            ('bytes=0-1,5-6', None),
+            ('items=0-1', None),
+        ]
+        for header, expected in cases:
+            with self.subTest(header):
+                self.assertEqual(_parse_range(header, 1000), expected)
+
+
+class DuplicateIndexTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = DuplicateIndex()
+
+    def hashes(self, image):
+        return image.phash, image.dhash, image.whash
+
+    def test_follows_inserts_and_deletes(self):
+        first, second = create_catalogue(2, hashed=True)
+        self.assertEqual(self.index.find(self.hashes(first)), first)
+
+        third = create_catalogue(1, hashed=True, seed=1)[0]
+        self.assertEqual(self.index.find(self.hashes(third)), third)
+
+        second.delete()
+        self.assertIsNone(self.index.find(self.hashes(second)))
+        self.assertEqual(self.index.find(self.hashes(first)), first)
+
+    def test_excludes_the_image_itself(self):
+        image = create_catalogue(1, hashed=True)[0]
+        self.assertIsNone(self.index.find(self.hashes(image), exclude_pk=image.pk))
+
+    def test_rehashing_needs_invalidate(self):
+        image, other = create_catalogue(2, hashed=True)
+        old_hashes = self.hashes(image)
+        self.index.find(old_hashes)
+
+        Image.objects.filter(pk=image.pk).update(phash=other.phash, dhash=other.dhash, whash=other.whash)
+        self.index.invalidate()
+        self.assertIsNone(self.index.find(old_hashes))
+        self.assertEqual(self.index.find(self.hashes(other)), image)
+
+    def test_hashes_arriving_out_of_order(self):
+        first, queued, last = create_catalogue(3, hashed=True)
+        hashes = self.hashes(queued)
+        Image.objects.filter(pk=queued.pk).update(phash=None, dhash=None, whash=None)
+        self.index.find(self.hashes(first))
+
+        # Same count and highest pk as before, without invalidate()
+        Image.objects.filter(pk=first.pk).update(phash=None, dhash=None, whash=None)
+        Image.objects.filter(pk=queued.pk).update(phash=hashes[0], dhash=hashes[1], whash=hashes[2])
+        self.assertEqual(self.index.find(hashes), queued)
+        self.assertIsNone(self.index.find(self.hashes(first)))
+
+    def test_check_for_duplicates(self):
+        original = synthetic_wallpaper((640, 360))
+        stored = Image(image=SimpleUploadedFile('original.jpg', original, 'image/jpeg'))
+        stored.save()
+
+        # Same bytes, same picture resized and re-encoded, another picture
+        cases = [
+            (original, stored),
+            (synthetic_wallpaper((320, 180), format='PNG'), stored),
+            (synthetic_wallpaper((640, 360), seed=7), None),
+        ]
+        for content, expected in cases:
+            with self.subTest(expected=expected):
+                upload = SimpleUploadedFile('upload.jpg', content, 'image/jpeg')
+                image = Image(image=upload, content_hash=ingest.content_hash(upload))
+                self.assertEqual(image.check_for_duplicates(), (expected is not None, expected))
+
+
+class IngestTests(MediaTestCase):
+    def queue(self, content, name='wallpaper.jpg'):
+        image = Image(image=SimpleUploadedFile(name, content, 'image/jpeg'), status=Image.Status.PROCESSING)
+        image.save()
+        return IngestJob.objects.create(image=image)
+
+    def test_claim_takes_jobs_in_order_once(self):
+        first = self.queue(synthetic_wallpaper((64, 36), seed=1))
+        second = self.queue(synthetic_wallpaper((64, 36), seed=2))
+
+        claimed = IngestJob.claim()
+        self.assertEqual(claimed, first)
+        self.assertEqual((claimed.status, claimed.attempts), (IngestJob.Status.RUNNING, 1))
+        self.assertIsNotNone(claimed.started_at)
+        self.assertEqual(IngestJob.claim(), second)
+        self.assertIsNone(IngestJob.claim())
+
+    def test_ingest(self):
+        job = self.queue(synthetic_wallpaper((1920, 1080)))
+        IngestJob.claim().run()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.Status.DONE)
+        image = Image.objects.get(pk=job.image_id)
+        self.assertEqual(image.status, Image.Status.READY)
+        self.assertIsNotNone(image.phash)
+        self.assertEqual(image.hash_version, ingest.HASH_VERSION)
+
+    def test_invalid_and_duplicate_uploads_are_rejected(self):
+        self.queue(synthetic_wallpaper((1920, 1080)))
+        IngestJob.claim().run()
+        for content, error in (
+            (synthetic_wallpaper((1280, 720)), 'resolution is too low'),
+            (synthetic_wallpaper((1920, 1080), format='PNG'), 'duplicate'),
+        ):
+            with self.subTest(error):
+                job = self.queue(content, 'upload.png')
+                name = job.image.image.name
+                IngestJob.claim().run()
+
+                job.refresh_from_db()
+                self.assertEqual(job.status, IngestJob.Status.FAILED)
+                self.assertIn(error, job.error)
+                image = Image.objects.get(pk=job.image_id)
+                self.assertEqual(image.status, Image.Status.REJECTED)
+                self.assertFalse(image.image.storage.exists(name))
+
+    def test_unexpected_errors_are_retried(self):
+        job = self.queue(synthetic_wallpaper((64, 36)))
+        with mock.patch.object(Image, 'ingest', side_effect=OSError('connection reset')):
+            for attempt in range(1, IngestJob.MAX_ATTEMPTS + 1):
+                claimed = IngestJob.claim()
+                self.assertEqual(claimed.attempts, attempt)
+                claimed.run()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (IngestJob.Status.FAILED, 'connection reset'))
+        self.assertIsNone(IngestJob.claim())
+        self.assertEqual(Image.objects.get(pk=job.image_id).status, Image.Status.REJECTED)
+
+    def test_stale_jobs_are_requeued(self):
+        job = self.queue(synthetic_wallpaper((64, 36)))
+        IngestJob.claim()
+        self.assertEqual(IngestJob.requeue_stale(datetime.timedelta(hours=1)), 0)
+        self.assertEqual(IngestJob.requeue_stale(datetime.timedelta(0)), 1)
+        self.assertEqual(IngestJob.claim(), job)
+
+
+class ReviewTests(MediaTestCase):
+    def test_bulk_approve_skips_images_not_ready(self):
+        ready, processing, rejected = self.create_images(3, approved=False)
+        Image.objects.filter(pk=processing.pk).update(status=Image.Status.PROCESSING)
+        rejected.reject()
+
+        self.assertEqual(Image.objects.all().approve(), 1)
+        self.assertEqual(list(Image.objects.filter(is_approved=True)), [ready])
+        ready.refresh_from_db()
+        self.assertIsNotNone(ready.approval_date)
+        self.assertIn('thumbnail', ready.renditions)
+
+    @override_settings(APPROVE_INLINE_RENDITIONS=1)
+    def test_bulk_approve_bounds_inline_renditions(self):
+        self.create_images(3, approved=False)
+        self.assertEqual(Image.objects.all().approve(), 3)
+        self.assertEqual(Image.objects.filter(is_approved=True).exclude(renditions={}).count(), 1)
+
+    @override_settings(INGEST_ASYNC=True)
+    def test_bulk_approve_queues_renditions(self):
+        images = self.create_images(2, approved=False)
+        # A job left from the processing of the upload is reused
+        IngestJob.objects.create(image=images[0], status=IngestJob.Status.DONE, attempts=1)
+        Image.objects.all().approve()
+        self.assertFalse(Image.objects.exclude(renditions={}).exists())
+
+        while (job := IngestJob.claim()) is not None:
+            self.assertEqual(job.task, IngestJob.Task.RENDITIONS)
+            job.run()
+            self.assertEqual(job.status, IngestJob.Status.DONE)
+        self.assertFalse(Image.objects.filter(renditions={}).exists())
+
+    @override_settings(INGEST_ASYNC=True)
+    def test_failed_renditions_keep_the_image(self):
+        image = self.create_images(1, approved=False)[0]
+        Image.objects.all().approve()
+        with mock.patch.object(Image, 'generate_renditions', side_effect=OSError('disk full')):
+            for _ in range(IngestJob.MAX_ATTEMPTS):
+                IngestJob.claim().run()
+        job = IngestJob.objects.get(image=image)
+        self.assertEqual((job.status, job.error), (IngestJob.Status.FAILED, 'disk full'))
+        image.refresh_from_db()
+        self.assertTrue(image.can_be_featured)
+
+    def test_approve_refuses_rejected_images(self):
+        image = self.create_images(1, approved=False)[0]
+        image.reject()
+        with self.assertRaises(ValidationError):
+            image.approve()
+        image.refresh_from_db()
+        self.assertFalse(image.is_approved)
+
+    def test_reject_frees_the_image(self):
+        image = self.create_images(1)[0]
+        name = image.image.name
+        self.assertEqual(Image.objects.filter(pk=image.pk).reject(), 1)
+
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.Status.REJECTED)
+        self.assertFalse(image.is_approved)
+        self.assertFalse(image.image)
+        self.assertIsNone(image.phash)
+        self.assertFalse(image.image.storage.exists(name))
+        # Rejecting twice is a no-op
+        self.assertEqual(Image.objects.filter(pk=image.pk).reject(), 0)
+
+    def test_reject_takes_down_renditions_and_variants(self):
+        images = self.create_images(2, hashed=True)
+        rejects = {'one': lambda image: image.reject(), 'bulk': lambda image: Image.objects.filter(pk=image.pk).reject()}
+        for image, (path, reject) in zip(images, rejects.items()):
+            with self.subTest(path):
+                image.generate_renditions()
+                ImageOfTheDay.objects.update_or_create(date=timezone.now().date(), defaults={'image': image})
+                self.client.get('/image-of-the-day.jpeg?fmt=webp').close()
+                storage = image.image.storage
+                files = [name for rendition in image.renditions.values() for name in rendition['files'].values()]
+                variants = f'variants/{image.content_hash}'
+                self.assertTrue(storage.exists(variants))
+
+                reject(image)
+                image.refresh_from_db()
+                self.assertEqual((image.renditions, image.placeholder, image.dominant_color), ({}, None, None))
+                self.assertFalse([name for name in files if storage.exists(name)])
+                self.assertFalse(storage.exists(variants))
+
+    def test_reject_unfeatures_today_and_planned_days(self):
+        self.create_images(4)
+        today = timezone.now().date()
+        planned = ImageOfTheDay.plan(3)
+        ImageOfTheDay.select_image_for_today()
+
+        planned[0].image.reject()
+        self.assertFalse(ImageOfTheDay.objects.filter(image=planned[0].image).exists())
+
+        replacement = ImageOfTheDay.select_image_for_today()
+        self.assertEqual(replacement.date, today)
+        self.assertNotEqual(replacement.image_id, planned[0].image_id)
+        self.assertTrue(replacement.image.can_be_featured)
+
+    def test_unshowable_days_are_replaced(self):
+        self.create_images(3)
+        image_of_day = ImageOfTheDay.select_image_for_today()
+        Image.objects.filter(pk=image_of_day.image_id).update(is_approved=False)
+
+        replaced = ImageOfTheDay.select_image_for_date(image_of_day.date)
+        self.assertEqual(replaced.pk, image_of_day.pk)
+        self.assertNotEqual(replaced.image_id, image_of_day.image_id)
+
+    def test_cached_day_follows_later_edits(self):
+        image = self.create_images(1)[0]
+        self.assertEqual(ImageOfTheDay.select_image_for_today().image.renditions, {})
+
+        image.generate_renditions()
+        image_of_day = ImageOfTheDay.select_image_for_today()
+        self.assertIn('thumbnail', image_of_day.image.renditions)
+        self.assertEqual(cache.get(ImageOfTheDay.cache_key(image_of_day.date)), image_of_day.pk)
+
+
+class FileReplacementTests(MediaTestCase):
+    def test_upload_hashed_by_the_form_is_not_hashed_again(self):
+        upload = SimpleUploadedFile('new.jpg', synthetic_wallpaper((64, 36), seed=5), 'image/jpeg')
+        image = Image(image=upload, content_hash=ingest.content_hash(upload))
+        image.calculate_image_hash()
+        with mock.patch('wallpapers.ingest.content_hash', wraps=ingest.content_hash) as content_hash:
+            image.save()
+        content_hash.assert_not_called()
+        self.assertIn(image.content_hash, image.image.name)
+
+    def test_new_file_on_existing_row(self):
+        image = self.create_images(1)[0]
+        image.content_hash = 'stale'
+        image.save()
+        old_name, old_phash = image.image.name, image.phash
+
+        content = synthetic_wallpaper((64, 36), seed=99)
+        image.image = SimpleUploadedFile('new.jpg', content, 'image/jpeg')
+        image.save()
+        image.refresh_from_db()
+
+        self.assertNotEqual(image.content_hash, 'stale')
+        self.assertNotEqual(image.image.name, old_name)
+        with image.image.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertNotEqual(image.phash, old_phash)
+        self.assertFalse(image.image.storage.exists(old_name))
+        # Approved, so its renditions were made from the new file
+        self.assertIn('thumbnail', image.renditions)
+
+
+class DownloadTests(TestCase):
+    """URL uploads are streamed and aborted as early as possible"""
+
+    def serve(self, content, headers=None):
+        """Make session.get answer content, returns the list of chunks sent"""
+        sent = []
+
+        def iter_content(chunk_size):
+            for start in range(0, len(content), chunk_size):
+                sent.append(start)
+                yield content[start:start + chunk_size]
+
+        response = mock.MagicMock(headers=headers or {})
+        response.iter_content.side_effect = iter_content
+        get = self.enterContext(mock.patch('wallpapers.ingest.session.get'))
+        get.return_value.__enter__.return_value = response
+        return sent
+
+    def test_download(self):
+        content = synthetic_wallpaper((1920, 1080))
+        self.serve(content)
+        with ingest.download('https://example.com/a.jpg') as spool:
+            self.assertEqual(spool.read(), content)
+
+    @override_settings(MAX_DOWNLOAD_BYTES=1000)
+    def test_content_length_over_the_limit(self):
+        sent = self.serve(b'x' * 2000, {'Content-Length': '2000'})
+        with self.assertRaisesMessage(ValidationError, 'too large'):
+            ingest.download('https://example.com/a.jpg')
+        self.assertEqual(sent, [])
+
+    def test_stream_over_the_limit(self):
+        content = synthetic_wallpaper((1920, 1080))
+        sent = self.serve(content * 4)
+        with override_settings(MAX_DOWNLOAD_BYTES=len(content) * 2):
+            with self.assertRaisesMessage(ValidationError, 'too large'):
+                ingest.download('https://example.com/a.jpg')
+        self.assertLess(len(sent) * ingest.DOWNLOAD_CHUNK_SIZE, len(content) * 3)
+
+    def test_low_resolution_aborts_after_the_header(self):
+        sent = self.serve(synthetic_wallpaper((1280, 720)) + b'\0' * 10 * ingest.DOWNLOAD_CHUNK_SIZE)
+        with self.assertRaisesMessage(ValidationError, 'resolution is too low'):
+            ingest.download('https://example.com/a.jpg')
+        self.assertEqual(len(sent), 1)
+
+    def test_unrecognized_content_aborts_after_the_probe(self):
+        sent = self.serve(b'<html>' + b' ' * (1300 * 1024) + b'</html>')
+        with self.assertRaisesMessage(ValidationError, 'not recognized'):
+            ingest.download('https://example.com/a.html')
+        self.assertEqual(len(sent) * ingest.DOWNLOAD_CHUNK_SIZE, ingest.HEADER_PROBE_BYTES)
+
+
+class ImageOfTheDayFileTests(MediaTestCase):
+    def test_conditional_and_range_requests(self):
+        image = self.create_images(1)[0]
+        ImageOfTheDay.objects.create(image=image, date=timezone.now().date())
+        with image.image.open('rb') as f:
+            content = f.read()
+        url = '/image-of-the-day.jpeg'
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        response.close()
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(content)}')
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+
+        self.assertEqual(self.client.get(url, HTTP_RANGE=f'bytes={len(content)}-').status_code, 416)
+        # A resume of another version of the file gets the whole new one
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_etag_follows_the_bytes(self):
+        image = self.create_images(1)[0]
+        ImageOfTheDay.objects.create(image=image, date=timezone.now().date())
+        response = self.client.get('/image-of-the-day.jpeg')
+        response.close()
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/image-of-the-day.jpeg', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # New bytes that look the same to the perceptual hashes
+        image_hash = Image.objects.get(pk=image.pk).image_hash
+        image.image = SimpleUploadedFile('new.jpg', synthetic_wallpaper((64, 36), seed=99), 'image/jpeg')
+        image.save()
+        Image.objects.filter(pk=image.pk).update(image_hash=image_hash)
+        response = self.client.get('/image-of-the-day.jpeg', HTTP_IF_NONE_MATCH=etag)
+        response.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class MediaTests(MediaTestCase):
+    def test_media_served_without_debug(self):
+        image = self.create_images(1)[0]
+        image.generate_renditions()
+        for name in (image.image.name, image.renditions['thumbnail']['files']['jpeg']):
+            with self.subTest(name):
+                response = self.client.get(f'/media/{name}')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'image/jpeg')
+                with image.image.storage.open(name) as f:
+                    self.assertEqual(b''.join(response.streaming_content), f.read())
+
+        for path in ('wallpapers/missing.jpg', '../settings.py', 'wallpapers/'):
+            with self.subTest(path):
+                self.assertEqual(self.client.get(f'/media/{path}').status_code, 404)
+
+
+class VariantTests(MediaTestCase):
+    def parse(self, query):
+        return parse_request(RequestFactory().get('/image-of-the-day.jpeg', query))[:2]
+
+    def test_sizes_are_restricted(self):
+        self.assertEqual(self.parse({'w': 800}), (896, None))
+        self.assertEqual(self.parse({'h': 1080}), (None, 1152))
+        self.assertEqual(self.parse({'w': 2560, 'h': 1440}), (2560, 1440))
+        # Portrait orientation of an allowed size
+        self.assertEqual(self.parse({'w': 1170, 'h': 2532}), (1170, 2532))
+        for query in ({'w': 1171, 'h': 2532}, {'w': 0}, {'w': 9000}, {'h': 'big'}):
+            with self.subTest(query), self.assertRaises(InvalidVariant):
+                self.parse(query)
+
+    def test_one_variant_per_output_size(self):
+        image = self.create_images(1)[0]
+        image.image.storage.delete(image.image.name)
+        image.image.storage.save(image.image.name, BytesIO(synthetic_wallpaper((640, 360))))
+        ImageOfTheDay.objects.create(image=image, date=timezone.now().date())
+
+        etags = set()
+        for query in ('?w=200', '?w=250', '?w=256&fmt=jpg', '?w=1280&h=720'):
+            response = self.client.get(f'/image-of-the-day.jpeg{query}')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            etags.add(response['ETag'])
+        # Snapped to 256 wide, and 1280x720 is larger than the source, which
+        # is served as it is
+        self.assertEqual(len(etags), 2)
+        self.assertEqual(self.client.get('/image-of-the-day.jpeg?w=1281&h=720').status_code, 400)
+
+    def test_variants_are_dated_like_their_original(self):
+        image = self.create_images(1)[0]
+        today = timezone.now().date()
+        ImageOfTheDay.objects.create(image=image, date=today)
+        midnight = datetime.datetime.combine(today, datetime.time.min, tzinfo=datetime.timezone.utc)
+        os.utime(image.image.path, (0, 0))
+
+        for _ in range(2):
+            response = self.client.get('/image-of-the-day.jpeg?fmt=webp')
+            response.close()
+            self.assertEqual(response['Last-Modified'], http_date(midnight.timestamp()))
+        response = self.client.get('/image-of-the-day.jpeg?fmt=webp', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get(self, url='/'):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_anonymous_pages_are_cached(self):
+        images = create_catalogue(3)
+        # Selecting the day invalidates the pages, do it before they are cached
+        ImageOfTheDay.select_image_for_today()
+        for url, view in (('/', 'home'), (f'/image/{images[0].pk}/', 'image_detail')):
+            with self.subTest(view):
+                hits = caching.cache_stats().get((view, 'hit'), 0)
+                self.assertEqual(self.get(url)['X-Cache'], 'MISS')
+                self.assertEqual(self.get(url)['X-Cache'], 'HIT')
+                self.assertEqual(caching.cache_stats()[(view, 'hit')], hits + 1)
+
+        # Staff see pending images and their own messages
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertNotIn('X-Cache', self.get())
+
+    @override_settings(APPROVE_INLINE_RENDITIONS=0)
+    def test_approving_and_deleting_invalidate(self):
+        approved = create_catalogue(2)
+        pending = create_catalogue(1, approved=False)[0]
+        ImageOfTheDay.select_image_for_today()
+        self.get()
+        self.assertEqual(self.get()['X-Cache'], 'HIT')
+
+        Image.objects.filter(pk=pending.pk).approve()
+        response = self.get()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, f'/image/{pending.pk}/')
+
+        approved[1].delete()
+        response = self.get()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotContains(response, f'/image/{approved[1].pk}/')
+
+    def test_evicted_version_is_never_reused(self):
+        seen = {caching.content_version()}
+        caching.invalidate()
+        seen.add(caching.content_version())
+
+        cache.delete(caching.VERSION_CACHE_KEY)
+        self.assertNotIn(caching.content_version(), seen)
+        cache.delete(caching.VERSION_CACHE_KEY)
+        caching.invalidate()
+        self.assertNotIn(caching.content_version(), seen)
+
+
+class BenchmarkTests(MediaTestCase):
+    """The suites of `manage.py benchmark` run, at a tiny size"""
+
+    options = {'sizes': [30], 'queries': 3, 'repeat': 1, 'legacy_limit': 30, 'seed': 0}
+
+    def test_suites(self):
+        for suite in (benchmarks.dedup, benchmarks.iotd_selection, benchmarks.query_plans, benchmarks.view_queries):
+            with self.subTest(suite.__name__):
+                rows = suite(self.options)
+                self.assertTrue(rows)
+                self.assertFalse(Image.objects.exists())
+        # The aggregate selection doesn't grow with the number of featured images
+        rows = benchmarks.iotd_selection(self.options)
+        self.assertEqual(len({row['queries'] for row in rows if row['case'] == 'aggregate'}), 1)
+
+    def test_compare(self):
+        baseline = [{'suite': 'views', 'case': 'home', 'mean_ms': 10.0}]
+        rows = [{'suite': 'views', 'case': 'home', 'mean_ms': 5.0}, {'suite': 'views', 'case': 'new', 'mean_ms': 1.0}]
+        self.assertEqual(list(benchmarks.compare(rows, baseline)), [
+            {'suite': 'views', 'case': 'home', 'mean_ms': 5.0, 'mean_ms_change': '-50.0%'},
+            {'suite': 'views', 'case': 'new', 'mean_ms': 1.0},
+        ])
+
+
+class MetricsTests(TestCase):
+    def test_unknown_methods_share_a_series(self):
+        for method in ('BREW', 'PROPFIND', 'GET'):
+            self.client.generic(method, '/api/images/')
+        methods = {
+            dict(labels)['method']
+            for name, labels in metrics.snapshot()['histograms']
+            if name == 'request_duration_seconds'
+        }
+        self.assertIn('other', methods)
+        self.assertFalse(methods & {'BREW', 'PROPFIND'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CaptchaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        self.enterContext(mock.patch('wallpapers.utils.captcha_breaker', self.breaker))
+        self.post = self.enterContext(mock.patch('wallpapers.utils.session.post'))
+
+    def test_unexpected_response_closes_the_trial(self):
+        self.breaker.record_failure()
+        self.post.return_value.json.return_value = ['not', 'an', 'object']
+        with self.assertLogs('wallpapers.utils', 'WARNING'):
+            self.assertFalse(verify_captcha('token'))
+
+        # The failed trial reopened the circuit, the next one is let through
+        self.post.return_value.json.return_value = {'success': True}
+        self.assertTrue(verify_captcha('token'))
+        self.assertFalse(self.breaker.is_open)
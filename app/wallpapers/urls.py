@@ -6,9 +6,13 @@ urlpatterns = [
     path('image/<int:pk>/', views.ImageDetailView.as_view(), name='image_detail'),
     path('upload/', views.upload_image, name='upload_image'),
     path('upload/url/', views.upload_image_url, name='upload_image_url'),
+    path('upload/status/<int:pk>/', views.upload_status, name='upload_status'),
     path('review/', views.PendingReviewListView.as_view(), name='pending_review'),
     path('approve/<int:pk>/', views.approve_image, name='approve_image'),
+    path('review/bulk/', views.bulk_review, name='bulk_review'),
     path('image-of-the-day/', views.image_of_the_day, name='image_of_the_day'),
+    path('api/images/', views.images_api, name='images_api'),
     path('api/image-of-the-day/', views.image_of_the_day_api, name='image_of_the_day_api'),
     path('image-of-the-day.jpeg', views.image_of_the_day_direct, name='image_of_the_day_direct'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
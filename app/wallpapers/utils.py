@@ -1,23 +1,115 @@
+import hashlib
+import logging
+import threading
+import time
+
 import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the cap server, connecting and reading alike
+CAPTCHA_TIMEOUT = 3
+
+# Seconds a rejected token is remembered, so that a client retrying a bad
+# token doesn't reach the cap server. Successes aren't cached: tokens are
+# single use and a cached success could be replayed.
+CAPTCHA_REJECTION_TTL = 60
+
+# Connections to the cap server are kept alive between verifications
+session = requests.Session()
+
+
+class CircuitBreaker:
+    """Stop calling a failing service for a while
+
+    After `threshold` consecutive failures calls are refused for
+    `reset_timeout` seconds, then a single trial call decides whether the
+    circuit closes again or stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
 
+    def allow(self):
+        """Whether a call may be attempted now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+captcha_breaker = CircuitBreaker()
+
+
+@metrics.timed('verify_captcha')
 def verify_captcha(captcha_token):
     """
     Verify the captcha token with the cap server
     Returns True if verification succeeds, False otherwise
+
+    Verification fails straight away, without waiting for a timeout, while
+    the cap server keeps failing (see captcha_breaker).
     """
-    import os
-    client_id = 'bd4f205aa0ab'
-    client_secret = os.environ.get('CAPTCHA_CLIENT_SECRET', '')
-    verify_url = f'https://cap.ozeliurs.com/{client_id}/siteverify'
-    
+    cache_key = f'wallpapers:captcha-rejected:{hashlib.sha256(captcha_token.encode()).hexdigest()}'
+    if cache.get(cache_key):
+        metrics.increment('captcha_verifications_total', outcome='cached')
+        return False
+
+    if not captcha_breaker.allow():
+        metrics.increment('captcha_verifications_total', outcome='circuit_open')
+        return False
+
+    start = time.perf_counter()
     try:
-        response = requests.post(verify_url, json={
-            'secret': client_secret,
+        response = session.post(settings.CAPTCHA_VERIFY_URL, json={
+            'secret': settings.CAPTCHA_CLIENT_SECRET,
             'response': captcha_token
-        })
+        }, timeout=CAPTCHA_TIMEOUT)
         response.raise_for_status()
-        result = response.json()
-        return result.get('success', False)
-    except Exception as e:
-        print(f"Error verifying captcha: {e}")
+        result = bool(response.json().get('success', False))
+    except Exception:
+        # Anything unexpected, a body that isn't a JSON object included, must
+        # still be recorded or a half-open breaker would keep its trial taken
+        # and refuse every captcha from then on
+        captcha_breaker.record_failure()
+        metrics.increment('captcha_verifications_total', outcome='error')
+        metrics.observe('captcha_verify_seconds', time.perf_counter() - start, outcome='error')
+        logger.warning('Could not verify a captcha', exc_info=True)
         return False
+
+    captcha_breaker.record_success()
+    outcome = 'success' if result else 'rejected'
+    metrics.increment('captcha_verifications_total', outcome=outcome)
+    metrics.observe('captcha_verify_seconds', time.perf_counter() - start, outcome=outcome)
+    if not result:
+        cache.set(cache_key, True, CAPTCHA_REJECTION_TTL)
+    return result
@@ -0,0 +1,331 @@
+"""Device-sized variants of the image of the day
+
+Clients ask /image-of-the-day.jpeg for a size and a format
+(?w=2560&h=1440&fmt=webp, or an Accept header listing image/avif or
+image/webp) instead of downloading the original and downscaling it
+themselves. When both dimensions are given the image is cropped to their
+aspect ratio around its most detailed part, never upscaled.
+
+Every distinct size costs a decode and an encode, so sizes are restricted:
+a single dimension is rounded up to a multiple of SIZE_STEP, and both must
+be one of DEVICE_SIZES.
+
+Variants are encoded once and kept on disk under MEDIA_ROOT/variants, keyed
+by file content, output size and format. The directory is capped at
+settings.VARIANT_CACHE_MAX_BYTES, least recently served variants are evicted
+first.
+"""
+import fcntl
+import math
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+import numpy as np
+from PIL import Image as PILImage
+from PIL import ImageFilter, ImageOps
+from django.conf import settings
+
+from . import metrics
+from .renditions import available_formats
+
+# Directory of the cache, relative to MEDIA_ROOT so that the front web server
+# can send the files (see SENDFILE_BACKEND)
+CACHE_DIRECTORY = 'variants'
+
+# Largest width or height a client may ask for (8K)
+MAX_DIMENSION = 7680
+
+# A width or height asked alone is rounded up to a multiple of this
+SIZE_STEP = 128
+
+# Screen sizes (landscape, portrait ones are accepted too) that can be asked
+# for with both w and h
+DEVICE_SIZES = {
+    # Desktops and laptops
+    (1280, 720), (1280, 800), (1366, 768), (1440, 900), (1536, 864), (1600, 900),
+    (1680, 1050), (1920, 1080), (1920, 1200), (2048, 1152), (2560, 1080), (2560, 1440),
+    (2560, 1600), (2880, 1800), (3024, 1964), (3440, 1440), (3456, 2234), (3840, 1600),
+    (3840, 2160), (5120, 1440), (5120, 2880), (6016, 3384), (7680, 4320),
+    # Phones
+    (1334, 750), (1792, 828), (2340, 1080), (2400, 1080), (2436, 1125), (2532, 1170),
+    (2556, 1179), (2688, 1242), (2778, 1284), (2796, 1290), (3088, 1440), (3200, 1440),
+    # Tablets
+    (2048, 1536), (2160, 1620), (2266, 1488), (2360, 1640), (2388, 1668), (2732, 2048),
+}
+
+# Format names accepted in ?fmt=, besides those of renditions.FORMATS
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+# Side of the downscaled copy the smart crop measures detail on
+CROP_ANALYSIS_SIZE = 256
+
+# How much the smart crop favours the centre over an equally detailed edge
+CENTER_BIAS = 0.2
+
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+class InvalidVariant(ValueError):
+    pass
+
+
+def get_format(name):
+    """(name, PIL format, extension, MIME type, options) of a format name"""
+    name = FORMAT_ALIASES.get(name, name)
+    for fmt in available_formats():
+        if fmt[0] == name:
+            return fmt
+    raise InvalidVariant(f'Unsupported format {name}')
+
+
+def negotiate_format(accept):
+    """Best format explicitly listed in an Accept header, or None
+
+    Wildcards don't count, `curl` (*/*) keeps getting the original format.
+    """
+    accepted = set()
+    for item in accept.split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.lower())
+    # available_formats() is ordered from the smallest files to the largest
+    for fmt in available_formats():
+        if fmt[3] in accepted:
+            return fmt
+    return None
+
+
+def parse_request(request):
+    """Requested (width, height, format) of a variant
+
+    Missing dimensions are None, a dimension given alone is rounded up to
+    SIZE_STEP. The format is None when neither ?fmt= nor the Accept header
+    pick one.
+
+    Raises:
+        InvalidVariant: for dimensions or formats that can't be served
+    """
+    dimensions = []
+    for param in ('w', 'h'):
+        value = request.GET.get(param)
+        if value is None:
+            dimensions.append(None)
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            raise InvalidVariant(f'{param} must be an integer')
+        if not 1 <= value <= MAX_DIMENSION:
+            raise InvalidVariant(f'{param} must be between 1 and {MAX_DIMENSION}')
+        dimensions.append(value)
+
+    width, height = dimensions
+    if width and height:
+        if (width, height) not in DEVICE_SIZES and (height, width) not in DEVICE_SIZES:
+            raise InvalidVariant(
+                f'{width}x{height} is not a supported screen size, ask for the width or the height alone'
+            )
+    elif width or height:
+        width, height = (-(-value // SIZE_STEP) * SIZE_STEP if value else None for value in (width, height))
+
+    if request.GET.get('fmt'):
+        fmt = get_format(request.GET['fmt'].lower())
+    else:
+        fmt = negotiate_format(request.headers.get('Accept', ''))
+    return width, height, fmt
+
+
+def source_size(fileobj):
+    """(width, height) of an image file as displayed, read from its header"""
+    img = PILImage.open(fileobj)
+    width, height = img.size
+    if img.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def output_size(source_size, width=None, height=None):
+    """Size of the variant of a source_size image asked as width x height
+
+    One dimension follows the aspect ratio of the source, two crop to theirs.
+    Either way the result is scaled down to fit in the source.
+    """
+    source_width, source_height = source_size
+    if width and not height:
+        height = round(source_height * width / source_width)
+    elif height and not width:
+        width = round(source_width * height / source_height)
+    elif not width and not height:
+        return source_size
+    scale = min(1, source_width / width, source_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def smart_crop_box(img, width, height):
+    """Box of img with the aspect ratio of width x height keeping the most detail
+
+    Detail is the edge energy of a small grayscale copy, summed along the
+    axis that is cropped: the box is slid along the other one to where it
+    holds the most.
+    """
+    target = width / height
+    if abs(img.width / img.height - target) < 0.01:
+        return 0, 0, img.width, img.height
+
+    small = img.convert('L')
+    small.thumbnail((CROP_ANALYSIS_SIZE, CROP_ANALYSIS_SIZE))
+    edges = np.asarray(small.filter(ImageFilter.FIND_EDGES), dtype=np.float64)
+    # FIND_EDGES lights up the border of the image, which isn't detail
+    edges[0, :] = edges[-1, :] = edges[:, 0] = edges[:, -1] = 0
+
+    horizontal = img.width / img.height > target
+    if horizontal:
+        extent, length, profile = round(img.height * target), img.width, edges.sum(axis=0)
+    else:
+        extent, length, profile = round(img.width / target), img.height, edges.sum(axis=1)
+
+    scale = len(profile) / length
+    window = max(1, min(len(profile), round(extent * scale)))
+    cumulative = np.concatenate(([0], np.cumsum(profile)))
+    totals = cumulative[window:] - cumulative[:-window]
+    positions = np.arange(len(totals))
+    middle = (len(totals) - 1) / 2
+    if middle:
+        # + 1 so that an image without any detail is cropped in its centre
+        totals = (totals + 1) * (1 - CENTER_BIAS * np.abs(positions - middle) / middle)
+    offset = min(length - extent, round(int(np.argmax(totals)) / scale))
+
+    if horizontal:
+        return offset, 0, offset + extent, img.height
+    return 0, offset, img.width, offset + extent
+
+
+def encode(fileobj, size, fmt):
+    """Bytes of an image file resized to size (see output_size), in the
+    (format tuple) fmt
+    """
+    _, pil_format, _, _, options = fmt
+    out_width, out_height = size
+    with metrics.span('encode_variant'):
+        source_width, source_height = source_size(fileobj)
+        fileobj.seek(0)
+        img = PILImage.open(fileobj)
+
+        # JPEGs can be decoded at a reduced scale, enough to still cover the
+        # cropped box at the output size
+        crop_scale = max(out_width / source_width, out_height / source_height)
+        img.draft('RGB', (math.ceil(img.width * crop_scale), math.ceil(img.height * crop_scale)))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+        box = smart_crop_box(img, out_width, out_height)
+        if (out_width, out_height) != img.size or box != (0, 0, img.width, img.height):
+            img = img.resize((out_width, out_height), PILImage.LANCZOS, box=box)
+        buffer = BytesIO()
+        img.save(buffer, pil_format, **options)
+        return buffer.getvalue()
+
+
+class VariantCache:
+    """Size-bounded directory of encoded variants with LRU eviction
+
+    Serving a variant bumps its mtime, eviction removes the oldest ones. A
+    lock file per variant makes concurrent requests, threads or gunicorn
+    workers alike, wait for a single encoding.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_or_create(self, key, create):
+        """Path of the cached file named key, calling create() for its bytes if missing"""
+        path = os.path.join(self.directory, key)
+        if self._touch(path):
+            metrics.increment('variant_cache_requests_total', result='hit')
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another request may have encoded it while we waited
+            if self._touch(path):
+                metrics.increment('variant_cache_requests_total', result='hit')
+                return path
+            content = create()
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        metrics.increment('variant_cache_requests_total', result='miss')
+        self.evict()
+        return path
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def purge(self, prefix):
+        """Remove every variant whose key starts with the directory prefix"""
+        shutil.rmtree(os.path.join(self.directory, prefix), ignore_errors=True)
+
+    def evict(self):
+        """Remove the least recently served variants until under max_bytes"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(('.lock', '.tmp')):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            for leftover in (path, path + '.lock'):
+                try:
+                    os.remove(leftover)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            metrics.increment('variant_cache_evictions_total')
+
+
+def variant_cache():
+    return VariantCache(os.path.join(settings.MEDIA_ROOT, CACHE_DIRECTORY), settings.VARIANT_CACHE_MAX_BYTES)
+
+
+def variant_key(image, size, fmt):
+    """Cache key of the variant of an Image at its output size
+
+    Requests resized to the same output share it, and a new file for the
+    image gets new variants.
+    """
+    return f'{variant_prefix(image)}/{size[0]}x{size[1]}.{fmt[2]}'
+
+
+def variant_prefix(image):
+    """Directory of the variants of an Image in the cache"""
+    return image.content_hash or f'image-{image.pk}'
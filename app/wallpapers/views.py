@@ -4,11 +4,26 @@ from django.contrib import messages
 from django.views.generic import ListView, DetailView
 from django.utils.decorators import method_decorator
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_POST
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.utils._os import safe_join
+import datetime
+import hmac
+import mimetypes
+import os
+from urllib.parse import urlencode
 
-from .models import Image, ImageOfTheDay
+from .models import Image, ImageOfTheDay, IngestJob
 from .forms import ImageUploadForm, ImageURLForm
+from .serving import serve_file
+from .caching import cache_for_anonymous
+from . import metrics, variants
+from .pagination import before, encode_cursor, paginate, parse_since
 
+@method_decorator(cache_for_anonymous('home'), name='dispatch')
 class HomeView(ListView):
     """Home page view showing the most recently approved images"""
     model = Image
@@ -17,7 +32,20 @@ class HomeView(ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        return Image.objects.filter(is_approved=True).order_by('-approval_date')
+        return Image.objects.filter(is_approved=True).order_by('-approval_date', '-id')
+    
+    def paginate_queryset(self, queryset, page_size):
+        # Cursor pages instead of numbered ones: no COUNT(*) and no OFFSET,
+        # deep pages cost the same as the first one
+        try:
+            page = paginate(
+                queryset, page_size,
+                after_cursor=self.request.GET.get('after'),
+                before_cursor=self.request.GET.get('before'),
+            )
+        except ValueError:
+            raise Http404('Invalid page cursor')
+        return None, page, page.object_list, page.has_next or page.has_previous
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -26,6 +54,7 @@ class HomeView(ListView):
         context['image_of_the_day'] = image_of_the_day
         return context
 
+@method_decorator(cache_for_anonymous('image_detail'), name='dispatch')
 class ImageDetailView(DetailView):
     """Detail view for a single image"""
     model = Image
@@ -38,6 +67,12 @@ class ImageDetailView(DetailView):
             return Image.objects.all()
         return Image.objects.filter(is_approved=True)
 
+def upload_message(image, uploaded):
+    """Success message shown after an upload, depending on whether it is queued"""
+    if image.status == Image.Status.PROCESSING:
+        return f'{uploaded} and is being processed. It will be pending approval once processed.'
+    return f'{uploaded} and is pending approval.'
+
 def upload_image(request):
     """View for uploading images from a file"""
     if request.method == 'POST':
@@ -45,7 +80,7 @@ def upload_image(request):
         if form.is_valid():
             image = form.save()
             if image:
-                messages.success(request, 'Your image has been uploaded and is pending approval.')
+                messages.success(request, upload_message(image, 'Your image has been uploaded'))
                 return redirect('image_detail', pk=image.pk)
             else:
                 # If save returned None, it means no image was created (e.g., a duplicate)
@@ -71,7 +106,7 @@ def upload_image_url(request):
             try:
                 image = form.save()
                 if image:
-                    messages.success(request, 'Your image has been uploaded from URL and is pending approval.')
+                    messages.success(request, upload_message(image, 'Your image has been uploaded from URL'))
                     return redirect('image_detail', pk=image.pk)
                 else:
                     # If save returned None, it means no image was created (e.g., a duplicate)
@@ -100,16 +135,63 @@ class PendingReviewListView(ListView):
     paginate_by = 20
     
     def get_queryset(self):
-        return Image.objects.filter(is_approved=False).order_by('upload_date')
+        return Image.objects.filter(is_approved=False, status=Image.Status.READY).order_by('upload_date')
+
+def upload_status(request, pk):
+    """API endpoint reporting the processing status of an upload"""
+    image = get_object_or_404(Image.objects.select_related('ingest_job'), pk=pk)
+    job = getattr(image, 'ingest_job', None)
+    # The job may since have been reused for the renditions, its error is
+    # then not the reason of the rejection
+    rejected_by_job = job and job.task == IngestJob.Task.INGEST and image.status == Image.Status.REJECTED
+    
+    return JsonResponse({
+        'id': image.id,
+        'status': image.status,
+        'error': job.error if rejected_by_job else '',
+    })
 
 @staff_member_required
 def approve_image(request, pk):
     """Admin view for approving an image"""
     image = get_object_or_404(Image, pk=pk)
-    image.approve()
+    try:
+        image.approve()
+    except ValidationError as e:
+        messages.error(request, ' '.join(e.messages))
+        return redirect('pending_review')
     messages.success(request, f'Image has been approved.')
     return redirect('pending_review')
 
+@staff_member_required
+@require_POST
+def bulk_review(request):
+    """Admin view for approving or rejecting several images at once
+    
+    Answers with JSON when asked to (keyboard shortcuts of the review page),
+    otherwise redirects back to the review page.
+    """
+    action = request.POST.get('action')
+    image_ids = [pk for pk in request.POST.getlist('image_ids') if pk.isdigit()]
+    wants_json = 'application/json' in request.headers.get('Accept', '')
+    
+    if action not in ('approve', 'reject'):
+        if wants_json:
+            return JsonResponse({'error': 'Unknown action'}, status=400)
+        messages.error(request, 'Unknown review action.')
+        return redirect('pending_review')
+    
+    images = Image.objects.filter(pk__in=image_ids)
+    if action == 'approve':
+        count = images.approve()
+    else:
+        count = images.reject()
+    
+    if wants_json:
+        return JsonResponse({'action': action, 'count': count, 'image_ids': [int(pk) for pk in image_ids]})
+    messages.success(request, f'{count} image(s) have been {action}d.')
+    return redirect('pending_review')
+
 def image_of_the_day(request):
     """View for displaying the image of the day"""
     image_of_day = ImageOfTheDay.select_image_for_today()
@@ -121,6 +203,7 @@ def image_of_the_day(request):
         'image_of_the_day': image_of_day
     })
 
+@cache_for_anonymous('image_of_the_day_api')
 def image_of_the_day_api(request):
     """API endpoint for getting the image of the day"""
     image_of_day = ImageOfTheDay.select_image_for_today()
@@ -130,10 +213,71 @@ def image_of_the_day_api(request):
     
     return JsonResponse({
         'date': image_of_day.date,
-        'image': {
-            'id': image_of_day.image.id,
-            'url': request.build_absolute_uri(image_of_day.image.image.url)
-        }
+        'image': serialize_image(request, image_of_day.image),
+    })
+
+def serialize_image(request, image):
+    """JSON representation of an approved image shared by the API endpoints"""
+    return {
+        'id': image.id,
+        'url': request.build_absolute_uri(image.image.url),
+        'approval_date': image.approval_date,
+        'image_hash': image.image_hash,
+        'hash_version': image.hash_version,
+        # Inline data URI and '#rrggbb' colour to show while the image loads
+        'placeholder': image.placeholder,
+        'dominant_color': image.dominant_color,
+        'renditions': {
+            size: {
+                'width': rendition['width'],
+                'height': rendition['height'],
+                'urls': {
+                    fmt: request.build_absolute_uri(image.image.storage.url(name))
+                    for fmt, name in rendition['files'].items()
+                },
+            }
+            for size, rendition in image.renditions.items()
+        },
+        'cursor': encode_cursor(image) if image.approval_date else None,
+    }
+
+def images_api(request):
+    """API endpoint listing the approved images
+    
+    By default images are listed newest first, a page at a time, following
+    the `next` URL. With ?since=<cursor or ISO 8601 datetime> they are
+    listed oldest first from that point on so that clients can sync
+    incrementally: keep following `next` and store the last `since` seen.
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 200)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+    
+    queryset = Image.objects.filter(is_approved=True, approval_date__isnull=False)
+    try:
+        if 'since' in request.GET:
+            position = parse_since(request.GET['since'])
+            images = list(queryset.filter(before(position)).order_by('approval_date', 'id')[:limit + 1])
+            has_more = len(images) > limit
+            images = images[:limit]
+            # Clients keep the last cursor to resume from, even when there
+            # was nothing new
+            since = encode_cursor(images[-1]) if images else request.GET['since']
+            next_query = {'since': since, 'limit': limit} if has_more else None
+            extra = {'since': since}
+        else:
+            page = paginate(queryset, limit, after_cursor=request.GET.get('after'))
+            images = page.object_list
+            next_query = {'after': page.next_cursor, 'limit': limit} if page.has_next else None
+            extra = {}
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    return JsonResponse({
+        'results': [serialize_image(request, image) for image in images],
+        'next': request.build_absolute_uri(f'?{urlencode(next_query)}') if next_query else None,
+        **extra,
     })
 
 def image_of_the_day_direct(request):
@@ -141,18 +285,30 @@ def image_of_the_day_direct(request):
     
     This allows direct access to the image file without HTML wrapping,
     making it suitable for curl requests like: curl <url>/image-of-the-day.jpeg
+    
+    Devices can ask for a variant sized and encoded for them, e.g.
+    ?w=2560&h=1440&fmt=webp, or get WebP/AVIF by listing it in their Accept
+    header (see variants.py). Variants are encoded once and then served from
+    an on-disk cache.
+    
+    The file is streamed (or handed to the web server, see SENDFILE_BACKEND)
+    rather than read into memory, and clients sending back the ETag or
+    Last-Modified they got get a 304 until the image changes.
     """
-    from django.http import HttpResponse, Http404
-    from django.views.decorators.cache import cache_control
-    import os
+    try:
+        width, height, fmt = variants.parse_request(request)
+    except variants.InvalidVariant as e:
+        return HttpResponseBadRequest(str(e), content_type='text/plain')
     
     image_of_day = ImageOfTheDay.select_image_for_today()
     
     if not image_of_day:
         raise Http404("No image of the day available")
     
+    image = image_of_day.image
+    
     # Get the file path
-    image_file = image_of_day.image.image.path
+    image_file = image.image.path
     
     # Get the file extension
     _, ext = os.path.splitext(image_file)
@@ -166,15 +322,74 @@ def image_of_the_day_direct(request):
         '.webp': 'image/webp',
     }
     content_type = content_type_map.get(ext.lower(), 'application/octet-stream')
+    etag = image.content_hash or str(image.pk)
     
-    # Read the file content
-    with open(image_file, 'rb') as f:
-        image_data = f.read()
+    # The original is served as it is unless it must be resized or re-encoded
+    if width or height or fmt:
+        with image.image.open('rb') as f:
+            source_size = variants.source_size(f)
+        size = variants.output_size(source_size, width, height)
+        if size != source_size or (fmt and fmt[3] != content_type):
+            fmt = fmt or variants.get_format('jpeg')
+            
+            def create():
+                with image.image.open('rb') as f:
+                    return variants.encode(f, size, fmt)
+            
+            key = variants.variant_key(image, size, fmt)
+            image_file = variants.variant_cache().get_or_create(key, create)
+            content_type = fmt[3]
+            etag = f'{etag}-{os.path.basename(key)}'
     
-    # Return the raw image with appropriate content type
-    response = HttpResponse(image_data, content_type=content_type)
+    # The image changes at midnight, possibly to a file older than the one
+    # a client already has, so Last-Modified can't be earlier than the day.
+    # Variants are dated like their original: the variant cache touches its
+    # files on every hit.
+    featured_since = datetime.datetime.combine(
+        image_of_day.date, datetime.time.min, tzinfo=datetime.timezone.utc
+    )
+    last_modified = max(
+        featured_since,
+        datetime.datetime.fromtimestamp(os.path.getmtime(image.image.path), tz=datetime.timezone.utc),
+    )
+    
+    response = serve_file(
+        request, image_file, content_type,
+        etag=etag,
+        last_modified=last_modified,
+    )
     
     # Add cache control headers (optional, to improve performance)
     response['Cache-Control'] = 'max-age=3600'  # Cache for 1 hour
+    # The format depends on the Accept header
+    patch_vary_headers(response, ['Accept'])
     
     return response
+
+def media_file(request, path):
+    """Serve an uploaded file (original, rendition) from MEDIA_ROOT
+    
+    Only routed with settings.SERVE_MEDIA. The file is streamed, or handed
+    to the front web server with SENDFILE_BACKEND, see serving.py.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+    
+    content_type, _ = mimetypes.guess_type(full_path)
+    return serve_file(request, full_path, content_type or 'application/octet-stream')
+
+def metrics_view(request):
+    """Prometheus endpoint exposing the metrics of the process that answers
+    
+    When settings.METRICS_TOKEN is set, scrapers must send it as a bearer
+    token.
+    """
+    token = settings.METRICS_TOKEN
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -50,5 +50,7 @@ else
     echo "Superuser already exists. Skipping creation."
 fi
 
-# Start Django development server
-python manage.py runserver 0.0.0.0:8000
+# Start the application server, see gunicorn.conf.py for its settings. DEBUG
+# is off (see the Dockerfile), uploads are served under /media/ by Django
+# unless SERVE_MEDIA is turned off for a front web server
+exec gunicorn wallpaper_site.wsgi:application --config gunicorn.conf.py